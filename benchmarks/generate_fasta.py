@@ -0,0 +1,82 @@
+import os
+import random
+import argparse
+
+STOP_CODONS = {"TAA", "TAG", "TGA"}
+DEFAULT_SEED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples", "inputs", "test.fasta")
+
+
+def read_seed(path):
+    # Nucleotides of the seed file, used as the ancestral sequence of every synthetic gene
+    with open(path, 'r') as f:
+        seed = "".join(line.strip().upper() for line in f if not line.startswith(">"))
+    seed = "".join(c for c in seed if c in "ACGT")
+    if len(seed) == 0:
+        raise ValueError(f"{path} has no nucleotides.")
+    return seed
+
+
+def value_range(text):
+    # "20" or "10:50" (uniform between the two values)
+    low, _, high = text.partition(":")
+    return int(low), int(high or low)
+
+
+def without_stops(sequence, rng):
+    codons = [sequence[i:i + 3] for i in range(0, len(sequence), 3)]
+    for n, codon in enumerate(codons):
+        while codon in STOP_CODONS:
+            codon = codon[:2] + rng.choice("ACGT")
+        codons[n] = codon
+    return "".join(codons)
+
+
+def synthetic_gene(seed, taxa, length, mutation, rng, identical=0.0):
+    # Taxa evolved from the same ancestor, so the alignment and the trees are not trivial
+    offset = rng.randrange(len(seed))
+    ancestor = (seed * (length // len(seed) + 2))[offset:offset + length]
+    ancestor = without_stops("".join(c if rng.random() > 0.25 else rng.choice("ACGT") for c in ancestor), rng)
+    sequences = []
+    for _ in range(taxa):
+        if len(sequences) > 0 and rng.random() < identical:
+            # Same sequence of a previous taxon, as in panels of closely related genomes
+            sequences.append(rng.choice(sequences))
+            continue
+        sequence = "".join(c if rng.random() > mutation else rng.choice("ACGT") for c in ancestor)
+        sequences.append(without_stops(sequence, rng))
+    return sequences
+
+
+def generate(output, files, taxa, length, seed_fasta=DEFAULT_SEED, mutation=0.05, per_folder=0, random_seed=1, identical=0.0):
+    rng = random.Random(random_seed)
+    seed = read_seed(seed_fasta)
+    paths = []
+    for n in range(files):
+        folder = output if per_folder <= 0 else os.path.join(output, f"group{n // per_folder:05d}")
+        os.makedirs(folder, exist_ok=True)
+        gene_taxa = rng.randint(*taxa)
+        # Codon alignments: the length is a multiple of 3
+        gene_length = max(3, rng.randint(*length) // 3 * 3)
+        path = os.path.join(folder, f"gene{n:06d}.fasta")
+        with open(path, 'w') as f:
+            for t, sequence in enumerate(synthetic_gene(seed, gene_taxa, gene_length, mutation, rng, identical)):
+                f.write(f">taxon{t + 1}\n{sequence}\n")
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic multi-FASTA files for benchmarking HighSPA.")
+    parser.add_argument("output", help="Folder where the fasta files are written.")
+    parser.add_argument("--files", help="Number of fasta files.", type=int, default=100)
+    parser.add_argument("--taxa", help="Sequences per file, a value or a range (e.g. 10:40).", type=value_range, default="8:16")
+    parser.add_argument("--length", help="Nucleotides per sequence, a value or a range (e.g. 300:1500).", type=value_range, default="300:900")
+    parser.add_argument("--seed-fasta", help="Fasta file whose nucleotides seed the synthetic genes.", default=DEFAULT_SEED)
+    parser.add_argument("--mutation", help="Probability of a site of a taxon differing from the ancestor.", type=float, default=0.05)
+    parser.add_argument("--identical", help="Probability of a sequence repeating a previous sequence of its file.", type=float, default=0.0)
+    parser.add_argument("--per-folder", help="Files per subfolder (0 writes all the files in the output folder).", type=int, default=0)
+    parser.add_argument("--random-seed", help="Seed of the generator, the same seed generates the same files.", type=int, default=1)
+    args = parser.parse_args()
+    paths = generate(args.output, args.files, args.taxa, args.length, args.seed_fasta, args.mutation,
+                     args.per_folder, args.random_seed, args.identical)
+    print(f"{len(paths)} files written to {args.output}")
@@ -0,0 +1,143 @@
+import os
+import sys
+import glob
+import json
+import time
+import bisect
+import shutil
+import argparse
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, "..", "src")
+sys.path.insert(0, SRC_DIR)
+from tracing import read_trace, last_of_stage, PREDECESSOR
+from generate_fasta import generate, value_range
+
+# "executors" routes the apps to the thread pool and the elastic HighThroughput pools of examples/executors/local.json
+EXECUTORS = {"threadpool": [], "htex": ["--htex"],
+             "executors": ["--executors-config", os.path.join(BENCH_DIR, "..", "examples", "executors", "local.json")]}
+# Metrics compared with --baseline (higher is better for tasks/s, lower for the others)
+REGRESSION_METRICS = {"tasks_per_second": 1, "makespan": -1, "time_to_first_task": -1, "dispatch_latency_p50": -1}
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measure(records, started, finished, workers):
+    # Orchestration metrics from the trace: when each task was launched by its worker (start - wait).
+    # The dispatch latency of a task counts from the last event that could have released it: the
+    # end of the task it depends on or, when the workers were busy, the end of any other task.
+    launched = sorted(r["start"] - r["wait"] for r in records)
+    ended = sorted(r["end"] for r in records)
+    by_stage = last_of_stage(records)
+    latencies = []
+    for r in records:
+        launch = r["start"] - r["wait"]
+        previous = PREDECESSOR.get(r["stage"], "raxml")
+        parent = by_stage.get((r["gene"], previous)) if previous is not None else None
+        finished_before = bisect.bisect_right(ended, launch)
+        events = [parent["end"]] if parent is not None else []
+        if finished_before > 0:
+            events.append(ended[finished_before - 1])
+        if len(events) > 0:
+            latencies.append(launch - max(events))
+    busy = ended[-1] - launched[0]
+    return {"tasks": len(records),
+            "makespan": finished - started,
+            "time_to_first_task": launched[0] - started,
+            "tasks_per_second": len(records) / busy if busy > 0 else float("nan"),
+            "dispatch_latency_mean": statistics.mean(latencies) if latencies else float("nan"),
+            "dispatch_latency_p50": percentile(latencies, 0.5),
+            "dispatch_latency_p95": percentile(latencies, 0.95),
+            # Share of the worker slots spent inside the tools while the workflow was running
+            "tool_occupancy": sum(r["wall"] for r in records) / (busy * workers) if busy > 0 else float("nan")}
+
+
+def run_highspa(executor, inputs, output, workers, models, extra, env):
+    shutil.rmtree(output, ignore_errors=True)
+    command = [sys.executable, "HighSPA.py", "-i", inputs, "-o", output, "-e", os.path.join(BENCH_DIR, "executables.json"),
+               "-t", str(workers), "--trace"] + models + EXECUTORS[executor] + extra
+    started = time.time()
+    # HighSPA reads the ctl templates from ./scripts, so it runs from src
+    result = subprocess.run(command, cwd=SRC_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    finished = time.time()
+    if result.returncode != 0:
+        raise RuntimeError(f"HighSPA failed with {executor}:\n{result.stderr[-2000:]}")
+    traces = sorted(glob.glob(os.path.join(output, "trace-*")))
+    if len(traces) == 0:
+        raise RuntimeError(f"HighSPA did not write a trace with {executor}.")
+    return measure(read_trace(traces[-1]), started, finished, workers)
+
+
+def report(results):
+    lines = [f"{'executor':<12} {'tasks':>6} {'makespan (s)':>13} {'first task (s)':>15} {'tasks/s':>9} "
+             f"{'dispatch p50/p95 (ms)':>22} {'tool occupancy':>15}"]
+    for executor, m in results.items():
+        lines.append(f"{executor:<12} {m['tasks']:>6} {m['makespan']:>13.2f} {m['time_to_first_task']:>15.2f} "
+                     f"{m['tasks_per_second']:>9.2f} {m['dispatch_latency_p50'] * 1000:>10.1f}/{m['dispatch_latency_p95'] * 1000:<11.1f}"
+                     f" {m['tool_occupancy']:>14.0%}")
+    return "\n".join(lines)
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for executor, m in results.items():
+        for metric, sign in REGRESSION_METRICS.items():
+            old = baseline.get(executor, {}).get(metric)
+            if old is None or old == 0:
+                continue
+            change = (m[metric] - old) / abs(old) * sign
+            if change < -tolerance:
+                found.append(f"{executor} {metric}: {old:.4g} -> {m[metric]:.4g}")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the orchestration overhead of HighSPA with stand-in tools.")
+    parser.add_argument("--workdir", help="Folder for the dataset and the outputs.", default="/tmp/highspa-benchmark")
+    parser.add_argument("--input", help="Existing input folder (by default a synthetic dataset is generated).", default=None)
+    parser.add_argument("--files", help="Number of synthetic fasta files.", type=int, default=50)
+    parser.add_argument("--taxa", help="Sequences per synthetic file, a value or a range.", default="8:16")
+    parser.add_argument("--length", help="Nucleotides per synthetic sequence, a value or a range.", default="300:900")
+    parser.add_argument("--workers", help="Workers of the executor (-t of HighSPA).", type=int, default=os.cpu_count())
+    parser.add_argument("--executors", help="Comma separated executors to compare.", default="threadpool,htex")
+    parser.add_argument("--models", help="Models executed after RAxML.", choices=["codeml", "hyphy", "both"], default="codeml")
+    parser.add_argument("--scale", help="Seconds of the stand-in tools per core-second of the planner's cost model.", type=float, default=0.01)
+    parser.add_argument("--mode", help="The stand-in tools 'sleep' or 'burn' the CPU.", choices=["sleep", "burn"], default="sleep")
+    parser.add_argument("--highspa-args", help="Extra arguments of HighSPA, e.g. '--bundle-size 20'.", default="")
+    parser.add_argument("--save", help="Json file where the metrics are saved.", default=None)
+    parser.add_argument("--baseline", help="Json file saved by a previous run; exits with 1 if a metric got worse.", default=None)
+    parser.add_argument("--tolerance", help="Relative change of a metric accepted by --baseline.", type=float, default=0.2)
+    args = parser.parse_args()
+
+    inputs = args.input
+    if inputs is None:
+        inputs = os.path.join(args.workdir, "inputs")
+        shutil.rmtree(inputs, ignore_errors=True)
+        generate(inputs, args.files, value_range(args.taxa), value_range(args.length))
+    env = dict(os.environ, HIGHSPA_BENCH_SCALE=str(args.scale), HIGHSPA_BENCH_MODE=args.mode,
+               HIGHSPA_BENCH_PYTHON=sys.executable,
+               # The stand-in tools come first; Parsl's interchange.py and process_worker_pool.py are next to python
+               PATH=os.pathsep.join([os.path.join(BENCH_DIR, "tools"), os.path.dirname(sys.executable), os.environ.get("PATH", "")]))
+    models = {"codeml": [], "hyphy": ["--hyphy"], "both": ["--both"]}[args.models]
+    results = dict()
+    for executor in args.executors.split(","):
+        output = os.path.join(args.workdir, f"outputs-{executor}")
+        results[executor] = run_highspa(executor, os.path.abspath(inputs), os.path.abspath(output), args.workers, models,
+                                        args.highspa_args.split(), env)
+    print(report(results))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"Regression: {line}")
+        sys.exit(1 if len(found) > 0 else 0)
@@ -0,0 +1,196 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+
+# Stand-in for MAFFT, RAxML, CodeML and HyPhy: takes the time given by the cost model of the
+# planner (scaled by HIGHSPA_BENCH_SCALE) sleeping or, with HIGHSPA_BENCH_MODE=burn, using
+# the CPU, and writes outputs in the formats read by the workflow.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from planner import estimate_costs
+
+SCALE = float(os.getenv("HIGHSPA_BENCH_SCALE", "0.01"))
+MODE = os.getenv("HIGHSPA_BENCH_MODE", "sleep")
+# HyPhy methods by the first two answers of the ctl files of src/scripts
+HYPHY_METHODS = {("1", "1"): "meme", ("1", "2"): "fel", ("1", "3"): "slac", ("1", "4"): "fubar",
+                 ("1", "6"): "absrel", ("13", "3"): "ny"}
+CODEML_NSSITES = {"0": "M0", "1": "M1", "2": "M2", "3": "M3", "7": "M7", "8": "M8"}
+# Extra free parameters of each model (besides the branch lengths) and lnL improvement over M0
+CODEML_PARAMETERS = {"M0": (2, 0), "M1": (3, 1.0), "M2": (5, 2.5), "M3": (6, 2.6), "M7": (3, 1.1), "M8": (5, 2.6)}
+
+
+def work(seconds, threads=1):
+    seconds = max(0.0, seconds)
+    if MODE != "burn":
+        time.sleep(seconds)
+        return
+    # One busy process per thread, so the CPU time matches the cost
+    children = []
+    for _ in range(max(1, threads) - 1):
+        pid = os.fork()
+        if pid == 0:
+            burn(seconds)
+            os._exit(0)
+        children.append(pid)
+    burn(seconds)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def burn(seconds):
+    end = time.time() + seconds
+    x = 0
+    while time.time() < end:
+        for i in range(10000):
+            x += i * i
+
+
+def read_fasta(path):
+    names, sequences = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                names.append(line[1:].split()[0])
+                sequences.append([])
+            elif len(names) > 0:
+                sequences[-1].append(line)
+    return names, ["".join(s) for s in sequences]
+
+
+def read_phylip(path):
+    with open(path, 'r') as f:
+        taxa, sites = f.readline().split()[:2]
+        names = [line.split()[0] for line in f if len(line.strip()) > 0]
+    return names[:int(taxa)], int(sites)
+
+
+def rng_for(*keys):
+    return random.Random(hashlib.sha256("|".join(map(str, keys)).encode()).hexdigest())
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def caterpillar(names, rng):
+    tree = names[0]
+    for name in names[1:]:
+        tree = f"({tree}:{rng.uniform(0.001, 0.2):.6f},{name}:{rng.uniform(0.001, 0.2):.6f})"
+    return tree + ";"
+
+
+def mafft(args):
+    # mafft --thread N --auto --phylipout --inputorder input > output
+    infile = args[-1]
+    threads = int(option(args, "--thread", "1"))
+    names, sequences = read_fasta(infile)
+    sites = max(len(s) for s in sequences)
+    work(estimate_costs(len(names), sites)["mafft"] * SCALE / threads, threads)
+    sys.stdout.write(f"{len(names)} {sites}\n")
+    for name, sequence in zip(names, sequences):
+        sys.stdout.write(f"{name:<12} {sequence.ljust(sites, '-')}\n")
+
+
+def raxml(args):
+    # raxmlHPC -s input -m GTRCAT -n name -w folder -p seed [-T N]
+    infile, name, folder = option(args, "-s"), option(args, "-n"), option(args, "-w", ".")
+    threads = int(option(args, "-T", "1"))
+    names, sites = read_phylip(infile)
+    work(estimate_costs(len(names), sites)["raxml"] * SCALE / threads, threads)
+    rng = rng_for(infile, option(args, "-p"))
+    tree = caterpillar(names, rng)
+    for kind in ("result", "bestTree", "parsimonyTree"):
+        with open(os.path.join(folder, f"RAxML_{kind}.{name}"), 'w') as f:
+            f.write(tree + "\n")
+    score = -rng.uniform(5, 10) * len(names) * sites
+    with open(os.path.join(folder, f"RAxML_info.{name}"), 'w') as f:
+        f.write(f"Stand-in RAxML run on {len(names)} taxa and {sites} sites\n\n")
+        f.write(f"Final GAMMA-based Score of best tree {score:.6f}\n")
+    with open(os.path.join(folder, f"RAxML_log.{name}"), 'w') as f:
+        f.write(f"0.0 {score:.6f}\n")
+
+
+def codeml(args):
+    # codeml codeml.ctl, executed in the folder of the model
+    with open(args[0] if len(args) > 0 else "codeml.ctl", 'r') as f:
+        ctl = dict(re.findall(r"^\s*(\w+)\s*=\s*(\S+)", f.read(), re.M))
+    model = CODEML_NSSITES.get(ctl.get("NSsites", "0"), "M0")
+    names, sites = read_phylip(ctl["seqfile"])
+    codons = sites // 3
+    work(estimate_costs(len(names), sites, codeml_models=[model])[model] * SCALE)
+    rng = rng_for(os.path.basename(ctl["seqfile"]))
+    ntime = max(1, 2 * len(names) - 3)
+    extra, gain = CODEML_PARAMETERS[model]
+    lnl = -rng.uniform(2, 4) * len(names) * codons + gain * rng.uniform(0.5, 2)
+    # Some initial values of omega/kappa end in a local optimum of the models with site classes
+    if model in ("M2", "M3", "M8"):
+        lnl -= rng_for(os.path.basename(ctl["seqfile"]), ctl.get("omega"), ctl.get("kappa")).choice([0, 0, 0, 0.8, 2.5])
+    omega = rng.uniform(0.05, 3)
+    lines = [f"Stand-in CODEML, {model}", "", f"lnL(ntime: {ntime:2d}  np: {ntime + extra:2d}):  {lnl:12.6f}      +0.000000", "",
+             f"kappa (ts/tv) = {rng.uniform(1, 5):9.5f}", ""]
+    if model == "M0":
+        lines.append(f"omega (dN/dS) = {omega:8.5f}")
+    else:
+        if model == "M7":
+            lines.append(f" p = {rng.uniform(0.1, 5):9.5f}  q = {rng.uniform(0.1, 5):9.5f}")
+        elif model == "M8":
+            lines.append(f"  p0 = {rng.uniform(0.5, 1):9.5f}  p = {rng.uniform(0.1, 5):9.5f} q = {rng.uniform(0.1, 5):9.5f}")
+        classes = {"M1": 2, "M2": 3, "M3": 3, "M7": 10, "M8": 11}[model]
+        p = [rng.random() for _ in range(classes)]
+        w = sorted(rng.uniform(0, 1) for _ in range(classes))
+        if model in ("M2", "M3", "M8"):
+            w[-1] = omega + 1
+        lines += ["", "p: " + "".join(f"{v / sum(p):9.5f}" for v in p), "w: " + "".join(f"{v:9.5f}" for v in w)]
+    if model in ("M2", "M8"):
+        lines += ["", "Bayes Empirical Bayes (BEB) analysis (Yang, Wong & Nielsen 2005. Mol. Biol. Evol. 22:1107-1118)",
+                  "Positively selected sites (*: P>95%; **: P>99%)", "", "            Pr(w>1)     post mean +- SE for w", ""]
+        for site in sorted(rng.sample(range(1, codons + 1), min(codons, 3))):
+            probability = rng.uniform(0.5, 1)
+            stars = "**" if probability > 0.99 else "*" if probability > 0.95 else ""
+            lines.append(f"{site:6d} {rng.choice('ACDEFGHIKLMNPQRSTVWY')}      {probability:.3f}{stars:<2}      "
+                         f"{omega + 1:.3f} +- {rng.uniform(0, 2):.3f}")
+        lines += ["", "", "The grid", ""]
+    with open(ctl["outfile"], 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    with open("rst", 'w') as f:
+        f.write(f"Stand-in rst of {model}\n")
+
+
+def hyphy(args):
+    # hyphy CPU=N -i < hyphy.ctl (answers of the interactive menu)
+    threads = int(next((a.split("=", 1)[1] for a in args if a.startswith("CPU=")), "1"))
+    answers = [line.strip() for line in sys.stdin]
+    method = HYPHY_METHODS.get(tuple(answers[:2]), "meme")
+    infile = next(a for a in answers if a.endswith(".phylip") or a.endswith(".mafft"))
+    outfile = next(a for a in answers if a.endswith(".results.json"))
+    names, sites = read_phylip(infile)
+    codons = max(1, sites // 3)
+    work(estimate_costs(len(names), sites, hyphy_models=[method])[method] * SCALE / threads, threads)
+    rng = rng_for(infile, method)
+    if method == "absrel":
+        result = {"branch attributes": {"0": {name: {"Corrected P-value": min(1, rng.random() * 3),
+                                                     "Uncorrected P-value": rng.random(), "LRT": rng.uniform(0, 10),
+                                                     "Rate classes": rng.randint(1, 3),
+                                                     "Baseline MG94xREV omega ratio": rng.uniform(0, 2)}
+                                              for name in names}}}
+    elif method == "ny":
+        result = {"fits": {model: {"Log Likelihood": -rng.uniform(2, 4) * len(names) * codons} for model in ("M1", "M2", "M7", "M8")}}
+    else:
+        headers = {"meme": ["alpha", "beta-", "p-", "beta+", "p+", "LRT", "p-value", "Total branch length"],
+                   "fel": ["alpha", "beta", "alpha=beta", "LRT", "p-value", "Total branch length"],
+                   "slac": ["ES", "EN", "S", "N", "P[S]", "dS", "dN", "dN-dS", "P [dN/dS > 1]", "P [dN/dS < 1]", "Total branch length"],
+                   "fubar": ["alpha", "beta", "beta-alpha", "Prob[alpha>beta]", "Prob[alpha<beta]", "BayesFactor[alpha<beta]"]}[method]
+        rows = [[rng.random() for _ in headers] for _ in range(codons)]
+        content = {"0": {"by-site": {"RESOLVED": rows, "AVERAGED": rows}}} if method == "slac" else {"0": rows}
+        result = {"MLE": {"headers": [[h, h] for h in headers], "content": content}}
+    with open(outfile, 'w') as f:
+        json.dump(result, f)
+
+
+if __name__ == "__main__":
+    tools = {"mafft": mafft, "raxml": raxml, "codeml": codeml, "hyphy": hyphy}
+    tools[sys.argv[1]](sys.argv[2:])
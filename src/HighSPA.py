@@ -1,51 +1,98 @@
 #!/usr/bin/env python3
-import os, sys, re, argparse, glob, random, logging
+import os, sys, argparse, random, shutil, logging
 from pathlib import Path
 from datetime import datetime
 import parsl
 from parsl.data_provider.files import File
 from config import *
 from apps import *
+from cache import hash_file, load_cache_seed
+from resources import ThreadModel, node_cpus, fasta_dimensions
+from planner import Plan, CODEML_WEIGHTS, HYPHY_WEIGHTS
+from streaming import scan_inputs, read_manifest, order_by_cost, InflightLimiter, settled
+from bundle import Bundler
+from results import CodemlResults
+from hyphy_store import HyphyStore
+from tracing import read_trace, report
+from multistart import MultiStart, START_MODELS
+from tree_search import search_dir
+from collapse import mapping_file
+from shards import read_coordinates, windows, shard_dir, first_codon
+from archive import log_files
+from runner import RUN_ID_ENV, ledger_dir
+
+
+def after(depends, *stage):
+    # Dependência extra (parâmetro inputs) de uma etapa da primeira ocorrência de um arquivo repetido
+    if depends is None or stage not in depends:
+        return []
+    return [depends[stage]]
+
+
+def remember(depends, future, *stage):
+    if depends is not None:
+        depends.setdefault(stage, future)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="HighSPA framework",
                                      description="Python script designed to automate phylogenetic analyses using a series of bioinformatics tools.")
     parser.add_argument(
-        "-t", "--threads", help="Maximum number of threads used by the workflow.", required=False, type=int, default=1)
+        "-t", "--threads", help="Maximum number of threads used by the workflow (default: 1).", required=False, type=int, default=None)
     parser.add_argument(
         "-i", "--input", help="Folder containing the fasta files used by the workflow.", required=True, type=str)
     parser.add_argument(
-        "-o", "--output", help="Folder where the outputs will be stored.", required=True, type=str)
+        "-o", "--output", help="Folder where the outputs will be stored.", required=False, type=str)
     parser.add_argument(
         "-s", "--seed", help="Folder where the outputs will be stored.", required=False, type=int)
     parser.add_argument("-e", "--executables",
-                        help="Json file containing the executables' info.", required=True, type=str)
+                        help="Json file containing the executables' info.", required=False, type=str)
     parser.add_argument("-env", "--environment",
                         help="Plain text file containing the environment variables and everything else that should be loaded in the worker node.", required=False, type=str, default=None)
     parser.add_argument("-m", "--monitoring", help="Flag to inform parsl to store metadata about the execution.",
                         action=argparse.BooleanOptionalAction, default=False)
     parser.add_argument("--onslurm", help="Flag to inform parsl to execute using the HighThroughput executor.",
                         action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--htex", help="Without --onslurm, uses a HighThroughputExecutor in the local machine instead of the ThreadPoolExecutor.", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--executors-config", help="Json file with the Parsl executors (thread pools and HighThroughput pools over a local or SLURM provider, with their workers per node and elastic blocks), the address/interface and ports of the interchange, and the executor of each app (routes). Replaces --htex and the default configuration of --onslurm (executors_slurm.json).", required=False, type=str, default=None)
     parser.add_argument("--hyphy", help="By default the workflow will process the sequences using CodeML, with this parameter the workflow will use HyPhy instead.", action=argparse.BooleanOptionalAction, default=False)
     parser.add_argument("--both", help="By default the workflow will process the sequences using CodeML, with this parameter the workflow will use both CodeML and HyPhy instead.", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--task-threads", help="Maximum number of threads of each MAFFT, RAxML and HyPhy task. The threads of a task are chosen from the size of its alignment and the free cores of the node (0 means up to all the cores of the node).", required=False, type=int, default=0)
+    parser.add_argument("--cache", help="Folder used as a persistent cache of the tools' outputs. Tasks whose inputs, executable, seed and ctl template did not change are restored from it instead of executed, and input files with identical content are processed only once (only with --cache).", required=False, type=str, default=None)
+    parser.add_argument("--order", help="Order used to submit the files: 'cost' submits the most expensive files first (estimated from the number of sequences, their length and the models) and 'input' keeps the order in which they are found. This is the only ordering: the executors run the tasks whose dependencies finished in the order they were submitted.", choices=["cost", "input"], default="cost")
+    parser.add_argument("--lookahead", help="Number of files read ahead to choose the most expensive one with --order cost (0 reads all the files before submitting the first task).", required=False, type=int, default=128)
+    parser.add_argument("--max-inflight", help="Maximum number of files with tasks submitted at the same time; new files are submitted as the previous ones finish (0 submits all the files at once).", required=False, type=int, default=1000)
+    parser.add_argument("--manifest", help="Text file listing the input files (relative to the input folder), one per line, optionally followed by the number of sequences and sites separated by tabs. Replaces the scan of the input folder.", required=False, type=str, default=None)
+    parser.add_argument("--bundle-size", help="Number of (file, model) pairs of CodeML/HyPhy executed by a single task, which reduces the orchestration overhead of small files (0 disables the bundles).", required=False, type=int, default=0)
+    parser.add_argument("--bundle-workers", help="Number of pairs of a bundle executed at the same time.", required=False, type=int, default=1)
+    parser.add_argument("--scratch", help="Runs CodeML and HyPhy in a temporary folder of the worker node (by default $TMPDIR, or the folder given) and copies back only the result files, removing the folder at the end even if the task fails.", nargs="?", const="$TMPDIR", type=str, default=None)
+    parser.add_argument("--scratch-keep", help="Comma separated glob patterns of the files copied back from the scratch folder (default: '*.results.*,rst').", required=False, type=str, default=None)
+    parser.add_argument("--collapse", help="Collapses the sequences of the MAFFT alignment that are identical (or, with a value, differ in up to that number of sites) into one representative before RAxML, CodeML and HyPhy. The full alignment is kept in <file>.full.mafft and <file>.collapsed.tsv maps each taxon to its representative.", nargs="?", const=0, type=int, default=None)
+    parser.add_argument("--raxml-searches", help="Number of RAxML tree searches of each file, with the seeds seed, seed+1, ..., executed in parallel tasks (raxml_searches/seed<n>); the tree with the best final GAMMA-based score is used by CodeML and HyPhy.", required=False, type=int, default=1)
+    parser.add_argument("--codeml-starts", help="Number of initial values of omega and kappa from which each model of --codeml-starts-models is optimized, in parallel tasks (model/start<n>); the start with the highest lnL is published as the result of the model (1 runs each model once, with the values of its template).", required=False, type=int, default=1)
+    parser.add_argument("--codeml-starts-models", help=f"Comma separated CodeML models executed from several starts (default: {','.join(START_MODELS)}).", required=False, type=str, default=",".join(START_MODELS))
+    parser.add_argument("--codeml-early-stop", help="With --codeml-starts, the starts not yet executed are skipped once this number of starts reached the best lnL of the model (0 executes all the starts).", required=False, type=int, default=0)
+    parser.add_argument("--shards", help="Tab separated file with the codon-aligned partitions of the alignments, one per line: name, first and last column (1-based), e.g. the proteins C, prM, E and NS1-NS5 of a genome. The partitions are cut from the MAFFT alignment and each one runs CodeML/HyPhy as independent tasks in <file>/shards/<name>, with the tree of the whole alignment; their sites are reported in the codons of the whole alignment (shards.tsv).", required=False, type=str, default=None)
+    parser.add_argument("--shard-window", help="Instead of --shards, splits the alignments into windows of this number of codons (the last window goes up to the end of the alignment).", required=False, type=int, default=0)
+    parser.add_argument("--archive", help="Instead of a folder per file, appends the outputs of each file (and the stdout/stderr of its tasks) to a few tar packs in output_folder/archive, indexed by archive/index.tsv, once all its tasks finish. The folders of the files are only kept in --archive-staging while they run (read one file with 'python3 archive.py cat output_folder/archive <file> <path>').", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--archive-staging", help="With --archive, folder of the files whose tasks are running, visible by all the workers, e.g. a scratch file system (default: output_folder/.staging).", required=False, type=str, default=None)
+    parser.add_argument("--trace", help="Records the wall time, CPU time, peak memory and bytes read and written of each task in output_folder/trace-<date> (a JSON lines file per node) and prints the critical path, the utilization of each stage and the idle cores at the end (summarize a trace with 'python3 tracing.py trace-<date>').", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--plan", help="Only prints the estimated core-hours and the ideal number of nodes for the input folder, without executing the workflow.", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--node-cpus", help="With --plan, cores of each node of the planned allocation (default: the node_cpus of --executors-config, otherwise SLURM_CPUS_ON_NODE, -t/--threads or the cores of this machine).", required=False, type=int, default=None)
     args = parser.parse_args()
+    if not args.plan and (args.output is None or args.executables is None):
+        parser.error("the following arguments are required: -o/--output, -e/--executables")
+    if args.shards and args.shard_window > 0:
+        parser.error("--shards and --shard-window cannot be used together")
     use_hyphy = args.hyphy
     use_both = args.both
     if args.seed:
         seed = args.seed
+    elif args.cache:
+        # Sem semente explícita, reutiliza a semente da execução anterior para que o cache do RAxML seja válido
+        seed = load_cache_seed(args.cache, random.randint(1, 1000))
     else:
         seed = random.randint(1, 1000)
-    # Carregar a configuração do Parsl e verifica o caminho dos executáveis
-    cfg = gen_config(threads=args.threads,
-                     label="default",
-                     monitoring=args.monitoring, slurm=args.onslurm,
-                     environment = args.environment)
-    executables = load_and_check_executables(args.executables)
-    parsl.set_file_logger(
-        f"Log-HighSPA-{datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}.log", level=logging.INFO)
-    parsl.set_stream_logger(stream=sys.stdout, level=logging.INFO)
-    logger = logging.getLogger()
-    parsl.load(cfg)
 
     # Execução do Codeml, agora puxando o diretório de saída de 'outputs'
     codeml_apps = {
@@ -57,6 +104,12 @@ if __name__ == "__main__":
         "M8": codeml
     }
 
+    # Modelos do CodeML otimizados a partir de vários valores iniciais
+    start_models = [model for model in args.codeml_starts_models.split(",") if len(model) > 0]
+    unknown = [model for model in start_models if model not in codeml_apps]
+    if len(unknown) > 0:
+        parser.error(f"--codeml-starts-models: unknown CodeML model(s) {', '.join(unknown)} (choose from {', '.join(codeml_apps)})")
+
     hyphy_apps = {
         "ny": hyphy,
         "meme": hyphy,
@@ -66,32 +119,161 @@ if __name__ == "__main__":
         "absrel": hyphy
     }
     # Pegando os argumentos
-    max_threads = args.threads
+    max_threads = args.threads or 1
     inputs = args.input
+    executors_conf = load_executors_config(args.executors_config) if args.executors_config else None
+    # Núcleos compartilhados pelas tarefas de um mesmo nó (ou da máquina local)
+    cpus = node_cpus(slurm=args.onslurm, threads=max_threads)
+    if executors_conf is not None and executors_conf.get("node_cpus"):
+        cpus = int(executors_conf["node_cpus"])
+    elif args.plan or executors_conf is not None:
+        # A estimativa não executa nada, e o arquivo de executores pode não informar os núcleos dos nós:
+        # sem -t, considera nós como o atual (a alocação do SLURM ou esta máquina)
+        cpus = node_cpus(slurm=True, threads=args.threads or os.cpu_count() or 1)
+    if args.plan and args.node_cpus:
+        cpus = args.node_cpus
+    thread_model = ThreadModel(cpus, args.task_threads)
+    # Partições de todos os alinhamentos (--shards); com --shard-window dependem do tamanho de cada arquivo
+    coordinates = None
+    if args.shards:
+        try:
+            coordinates = read_coordinates(args.shards)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+    # Execução do Codeml e/ou do Hyphy
+    to_run_codeml = True #Default
+    to_run_hyphy = False
+    if use_both == False:
+        if use_hyphy == True:
+            to_run_codeml = False
+            to_run_hyphy = True
+    else:
+        to_run_codeml = True
+        to_run_hyphy = True
 
-    # Procurando pelos arquivos fasta no diretório de entrada
-    fasta_files = glob.glob(os.path.join(inputs, '**'), recursive=True)
-    logger.info(f"Found {len(fasta_files)} files in {inputs}.")
-    fasta_files = list(filter(lambda x: os.path.isfile(x), fasta_files))
-    # Inicializando as listas de futuros para cada etapa
-    codeml_futures = {model: []
-                      for model in ["M0", "M1", "M2", "M3", "M7", "M8"]}
-    
-    hyphy_futures = {model: []
-                      for model in ["ny", "meme", "slac", "fubar", "fel", "absrel"]}
+    # Estimativa do custo de cada arquivo a partir do número de sequências e do seu tamanho
+    repeats = {"raxml": max(1, args.raxml_searches)}
+    if to_run_codeml:
+        repeats.update({model: max(1, args.codeml_starts) for model in start_models})
+    plan = Plan(codeml_models=list(codeml_apps) if to_run_codeml else [],
+                hyphy_models=list(hyphy_apps) if to_run_hyphy else [], repeats=repeats)
+
+    def planned_inputs():
+        # Procurando pelos arquivos fasta no diretório de entrada (ou no manifesto), à medida que são submetidos
+        if args.manifest:
+            found = read_manifest(args.manifest, inputs)
+        else:
+            found = ((path, None) for path in scan_inputs(inputs))
+        try:
+            for path, dimensions in found:
+                taxa, sites = dimensions or fasta_dimensions(path)
+                yield path, taxa, sites, plan.add(path, taxa, sites)
+        except (OSError, ValueError) as e:
+            # Linha inválida do manifesto (ou arquivo ilegível), encontrada à medida que os arquivos são submetidos
+            if not args.plan:
+                parsl.dfk().cleanup()
+            parser.error(str(e))
+
+    if args.plan:
+        for _ in planned_inputs():
+            pass
+        print(plan.report(cpus))
+        sys.exit(0)
+    entries = planned_inputs()
+    if args.order == "cost":
+        entries = order_by_cost(entries, cost=lambda e: sum(e[3].values()), window=args.lookahead)
+
+    # Cada execução tem o seu registro de núcleos nos nós, mesmo com várias execuções do mesmo usuário
+    os.environ[RUN_ID_ENV] = f"{datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}"
+    # Carregar a configuração do Parsl e verifica o caminho dos executáveis
+    cfg = gen_config(threads=max_threads,
+                     label="default",
+                     monitoring=args.monitoring, slurm=args.onslurm,
+                     environment = args.environment, htex=args.htex, executors=executors_conf)
+    # Cada app é enviada ao executor indicado pelas rotas do arquivo de executores
+    route_apps(executors_conf or {}, dict(mafft=mafft, raxml=raxml, raxml_best=raxml_best, codeml=codeml, hyphy=hyphy, bundle=bundle,
+                                          pack=pack))
+    executables = load_and_check_executables(args.executables)
+    parsl.set_file_logger(
+        f"Log-HighSPA-{datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}.log", level=logging.INFO)
+    parsl.set_stream_logger(stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger()
+    if executors_conf is not None and not executors_conf.get("node_cpus"):
+        logger.warning(f"{args.executors_config} has no node_cpus, the worker nodes are assumed to have {cpus} cores.")
+    parsl.load(cfg)
+    limiter = InflightLimiter(args.max_inflight)
+    # Arquivos do CodeML/HyPhy copiados de volta do scratch local do nó
+    # Registro dos recursos usados por cada tarefa
+    trace = None
+    if args.trace:
+        trace = os.path.join(os.path.abspath(args.output), f"trace-{datetime.now().strftime("%d-%m-%Y_%H-%M-%S")}")
+    scratch_keep = [p for p in args.scratch_keep.split(",") if len(p) > 0] if args.scratch_keep else None
+    # Agrupamento de pares (arquivo, modelo) do CodeML/HyPhy em uma única tarefa
+    bundler = None
+    if args.bundle_size > 1:
+        bundler = Bundler(bundle, args.bundle_size, os.path.join(args.output, ".bundles"), executables=executables,
+                          workers=args.bundle_workers, cache_dir=args.cache, node_cpus=cpus,
+                          scratch=args.scratch, keep=scratch_keep, trace=trace)
+    # Otimização do CodeML a partir de vários valores iniciais, mantendo o maior lnL
+    multistart = None
+    if to_run_codeml and args.codeml_starts > 1:
+        multistart = MultiStart(args.codeml_starts, models=start_models, seed=seed,
+                                stop_after=args.codeml_early_stop)
+    # Tabelas com os resultados do CodeML, atualizadas à medida que as tarefas terminam
+    codeml_results = CodemlResults(args.output) if to_run_codeml else None
+    # Com --archive, os diretórios dos arquivos ficam na área temporária até serem empacotados
+    genes_root = args.output
+    archive_dir = None
+    if args.archive:
+        genes_root = args.archive_staging or os.path.join(args.output, ".staging")
+        archive_dir = os.path.join(os.path.abspath(args.output), "archive")
+    # stdout/stderr das tarefas no diretório do arquivo, para que sejam empacotados com as saídas
+    logs = lambda directory, *name: log_files(directory, *name) if args.archive else {}
+    # Tabelas por sítio e por ramo do HyPhy, em arrays mapeados em memória
+    hyphy_store = HyphyStore(os.path.join(args.output, "hyphy_store")) if to_run_hyphy else None
+    if hyphy_store is not None and hyphy_store.compact() > 0:
+        # Entradas substituídas por uma execução anterior interrompida antes do fim
+        logger.info(f"Removed the replaced entries of {hyphy_store.root}.")
+    # Arquivos com conteúdo idêntico aguardam a primeira ocorrência e são restaurados do cache; as tarefas
+    # da primeira ocorrência são descartadas (None) quando ela termina, e as seguintes só leem o cache
+    first_occurrence = dict()
     # Execução do MAFFT
-    for i in fasta_files:
+    for rank, (i, taxa, sites, costs) in enumerate(entries):
+        # Aguarda uma vaga na janela de arquivos em execução
+        limiter.acquire(on_wait=bundler.flush if bundler is not None else None)
+        gene_futures = []
         prefix = Path(i).stem
+        depends = None
+        first = False
+        if args.cache:
+            digest = hash_file(i).hexdigest()
+            if digest in first_occurrence:
+                depends = first_occurrence[digest]
+                logger.info(f"{i} has the same content of a previous input, it will be restored from the cache.")
+            else:
+                depends = first_occurrence[digest] = dict()
+                first = True
         input_fullpath = os.path.dirname(i)
         path_to_add_out = os.path.relpath(input_fullpath, args.input)
         dir_outputs = Path(os.path.join(os.path.join(
-            args.output, path_to_add_out), prefix))
-        Path.mkdir(Path(dir_outputs), exist_ok=True, parents=True)
+            genes_root, path_to_add_out), prefix))
         output_mafft = os.path.join(dir_outputs, f"{prefix}.mafft")
         logger.info(f"Starting MAFFT for {
                     i}, output will be saved to {output_mafft}.")
-        ret_mafft = mafft(executables, multithread_parameter=1, infile=i,
-                          outputs=[File(output_mafft)])
+        outputs_mafft = [File(output_mafft)]
+        outputs_raxml = []
+        if to_run_codeml == True:
+            # Formatação do arquivo phylip e da árvore para o CodeML, feita nas próprias tarefas do MAFFT e do RAxML
+            outputs_mafft.append(File(os.path.join(dir_outputs, f"{prefix}_formatted.phylip")))
+            outputs_raxml.append(File(os.path.join(dir_outputs, f"RAxML_result.{prefix}_output_formatted.tree")))
+        shards = coordinates
+        if args.shard_window > 0:
+            shards = windows(sites, args.shard_window)
+        ret_mafft = mafft(executables, multithread_parameter=thread_model.threads("mafft", taxa, sites), infile=i,
+                          prefix=prefix, cache_dir=args.cache, node_cpus=cpus, trace=trace, collapse=args.collapse, shards=shards,
+                          **logs(dir_outputs, "mafft"), inputs=after(depends, "mafft"), outputs=outputs_mafft)
+        remember(depends, ret_mafft, "mafft")
         # Execução do READSEQ, cada um dependendo de um mafft
         # output_readseq = os.path.join(dir_outputs, f"{prefix}.phylip")
         # logger.info(f"Starting Readseq for {
@@ -103,51 +285,124 @@ if __name__ == "__main__":
         output_raxml = os.path.join(
             dir_outputs, f"RAxML_result.{prefix}_output.tree")
         logger.info(f"Starting RAxML, output will be saved to {output_raxml}.")
-        ret_raxml = raxml(executables, infile=ret_mafft.outputs[0], prefix=prefix, seed=seed, outputs=[
-                          File(output_raxml)])
-        # Execução do Codeml, aguardando os resultados de RAXML e Format Phylip
-        to_run_codeml = True #Default
-        to_run_hyphy = False
-        if use_both == False:
-            if use_hyphy == True:
-                to_run_codeml = False
-                to_run_hyphy = True
+        if args.raxml_searches > 1:
+            # Buscas independentes com sementes diferentes, em paralelo; a melhor árvore é copiada para o diretório do gene
+            searches = [search_dir(dir_outputs, seed + n) for n in range(args.raxml_searches)]
+            ret_searches = [raxml(executables, infile=ret_mafft.outputs[0], prefix=prefix, seed=seed + n,
+                                  threads=thread_model.threads("raxml", taxa, sites), cache_dir=args.cache, node_cpus=cpus,
+                                  trace=trace, search=n, **logs(dir_outputs, "raxml", f"search{n}"), inputs=after(depends, "raxml"),
+                                  outputs=[File(os.path.join(searches[n], f"RAxML_result.{prefix}_output.tree"))])
+                            for n in range(args.raxml_searches)]
+            # Executa quando todas as buscas terminam, mesmo com falhas: a melhor das buscas concluídas é usada
+            ret_raxml = raxml_best(prefix, searches, **logs(dir_outputs, "raxml", "best"), inputs=[settled(ret_searches)],
+                                   outputs=[File(output_raxml)] + outputs_raxml)
         else:
-            to_run_codeml = True
-            to_run_hyphy = True
-        if to_run_codeml == True:
-            # Formatação do arquivo phylip
-            output_formatted_phylip = os.path.join(
-                dir_outputs, f"{prefix}_formatted.phylip")
-            logger.info(f"Starting format_phylip for {
-                        output_mafft}, output will be saved to {output_formatted_phylip}.")
-            ret_format_phylip = format_phylip(infile=ret_mafft.outputs[0], prefix=prefix, outputs=[
-                                            File(output_formatted_phylip)])
-            output_formatted_raxml = os.path.join(dir_outputs, f"RAxML_result.{prefix}_output_formatted.tree")
-            ret_format_raxml = format_tree(infile=ret_raxml.outputs[0], prefix=prefix, outputs=[File(output_formatted_raxml)])
-            for model, app in codeml_apps.items():
-                output_codeml = os.path.join(dir_outputs, os.path.join(
-                    model, f"{model}_{prefix}.results.txt"))
-                # Adicionar a tarefa de Codeml
-                codeml_futures[model].append(
-                    app(executables, infile=ret_format_phylip.outputs[0], treefile=ret_format_raxml.outputs[0], prefix=prefix,
-                        model=model, dir_outputs=dir_outputs, outputs=[File(output_codeml)])
-                )
-        if to_run_hyphy == True:
-            # Execução do Hyphy, aguardando os resultados de RAXML e Phylip (saida do mafft)
-            for model, app in hyphy_apps.items():
-                output_hyphy = os.path.join(dir_outputs, os.path.join(
-                    model, f"{model}_{prefix}.results.json"))
-                # Adicionar a tarefa de Hyphy
-                hyphy_futures[model].append(
-                    app(executables, infile=ret_mafft.outputs[0], treefile=ret_raxml.outputs[0], prefix=prefix,
-                        model=model, dir_outputs=dir_outputs, outputs=[File(output_hyphy)])
-                )
+            ret_raxml = raxml(executables, infile=ret_mafft.outputs[0], prefix=prefix, seed=seed,
+                              threads=thread_model.threads("raxml", taxa, sites), cache_dir=args.cache, node_cpus=cpus, trace=trace,
+                              **logs(dir_outputs, "raxml"), inputs=after(depends, "raxml"), outputs=[File(output_raxml)] + outputs_raxml)
+        remember(depends, ret_raxml, "raxml")
+        # Cada partição do alinhamento (ou o alinhamento inteiro) executa os modelos com a árvore do gene
+        for shard, first_site in ([(None, 0)] if shards is None else [(name, first_codon(start)) for name, start, _ in shards]):
+            part = () if shard is None else (shard,)
+            part_dir = dir_outputs if shard is None else Path(shard_dir(dir_outputs, shard))
+            gene = os.path.relpath(part_dir, genes_root)
+            if shard is None:
+                alignments = ret_mafft.outputs
+                aligned = lambda k: [ret_mafft.outputs[k]]
+            else:
+                # Arquivos recortados pela tarefa do MAFFT, que as tarefas da partição aguardam
+                alignments = [File(os.path.join(part_dir, os.path.basename(f.filepath))) for f in outputs_mafft]
+                aligned = lambda k: [ret_mafft]
+            # Execução do Codeml, aguardando os resultados de RAXML e Format Phylip
+            if to_run_codeml == True:
+                # Os modelos mais caros são submetidos primeiro
+                for model, app in sorted(codeml_apps.items(), key=lambda m: CODEML_WEIGHTS[m[0]], reverse=True):
+                    output_codeml = os.path.join(part_dir, os.path.join(
+                        model, f"{model}_{prefix}.results.txt"))
+
+                    def submit_codeml(start=None, initial=None, marker=None):
+                        # Adicionar a tarefa de Codeml (ou de um dos seus pontos de partida)
+                        if bundler is not None:
+                            return bundler.add(dict(tool="codeml", infile=os.path.join(part_dir, f"{prefix}_formatted.phylip"),
+                                                    treefile=outputs_raxml[0].filepath, prefix=prefix, model=model,
+                                                    dir_outputs=str(dir_outputs), start=start, initial=initial, stop_marker=marker,
+                                                    shard=shard, **logs(part_dir, "codeml", model, None if start is None else f"start{start}")),
+                                               depends=aligned(1) + [ret_raxml.outputs[1]] + after(depends, "codeml", model, *part))
+                        output = output_codeml
+                        if start is not None:
+                            output = os.path.join(part_dir, model, f"start{start}", f"{model}_{prefix}.results.txt")
+                        return app(executables, infile=alignments[1], treefile=ret_raxml.outputs[1], prefix=prefix,
+                                   model=model, dir_outputs=dir_outputs, cache_dir=args.cache, node_cpus=cpus,
+                                   scratch=args.scratch, keep=scratch_keep, trace=trace,
+                                   start=start, initial=initial, stop_marker=marker, shard=shard,
+                                   **logs(part_dir, "codeml", model, None if start is None else f"start{start}"),
+                                   inputs=aligned(1) + after(depends, "codeml", model, *part), outputs=[File(output)])
+
+                    if multistart is not None and model in multistart.models:
+                        ret_codeml = multistart.add(submit_codeml, os.path.join(part_dir, model), prefix, model)
+                    else:
+                        ret_codeml = submit_codeml()
+                    gene_futures.append(ret_codeml)
+                    # Resultado lido pelo coletor de resultados; o arquivo só é empacotado depois dele
+                    gene_futures.append(codeml_results.watch(ret_codeml, gene, model, output_codeml, first_site))
+                    remember(depends, ret_codeml, "codeml", model, *part)
+            if to_run_hyphy == True:
+                # Execução do Hyphy, aguardando os resultados de RAXML e Phylip (saida do mafft)
+                for model, app in sorted(hyphy_apps.items(), key=lambda m: HYPHY_WEIGHTS[m[0]], reverse=True):
+                    output_hyphy = os.path.join(part_dir, os.path.join(
+                        model, f"{model}_{prefix}.results.json"))
+                    # Adicionar a tarefa de Hyphy
+                    if bundler is not None:
+                        ret_hyphy = bundler.add(dict(tool="hyphy", infile=os.path.join(part_dir, f"{prefix}.mafft"), treefile=output_raxml,
+                                                     prefix=prefix, model=model, dir_outputs=str(dir_outputs),
+                                                     threads=thread_model.threads("hyphy", taxa, sites), shard=shard,
+                                                     **logs(part_dir, "hyphy", model)),
+                                                depends=aligned(0) + [ret_raxml.outputs[0]] + after(depends, "hyphy", model, *part))
+                    else:
+                        ret_hyphy = app(executables, infile=alignments[0], treefile=ret_raxml.outputs[0], prefix=prefix,
+                                        model=model, dir_outputs=dir_outputs, threads=thread_model.threads("hyphy", taxa, sites),
+                                        cache_dir=args.cache, node_cpus=cpus, scratch=args.scratch, keep=scratch_keep, trace=trace,
+                                        shard=shard, **logs(part_dir, "hyphy", model),
+                                        inputs=aligned(0) + after(depends, "hyphy", model, *part), outputs=[File(output_hyphy)])
+                    gene_futures.append(ret_hyphy)
+                    # Resultado convertido pela thread do armazenamento; o arquivo só é empacotado depois dela
+                    gene_futures.append(hyphy_store.watch(ret_hyphy, gene, model, output_hyphy,
+                                                          mapping_file(output_mafft) if args.collapse is not None else None, first_site))
+                    remember(depends, ret_hyphy, "hyphy", model, *part)
+        if archive_dir is not None:
+            # Coletor do arquivo: executa depois de todas as suas tarefas (e dos callbacks dos resultados)
+            gene_futures.append(pack(archive_dir, dir_outputs, os.path.relpath(dir_outputs, genes_root),
+                                     stdout=(os.path.join(archive_dir, "pack.stdout"), "a"),
+                                     stderr=(os.path.join(archive_dir, "pack.stderr"), "a"),
+                                     inputs=[settled([ret_mafft, ret_raxml] + gene_futures)]))
+        limiter.track(gene_futures)
+        if first:
+            settled([ret_mafft, ret_raxml] + gene_futures).add_done_callback(
+                lambda _, digest=digest: first_occurrence.__setitem__(digest, None))
+        if (rank + 1) % 1000 == 0:
+            logger.info(f"{rank + 1} files submitted.")
 
+    if bundler is not None:
+        bundler.flush()
 
     parsl.wait_for_current_tasks()
+    if multistart is not None:
+        multistart.wait()
     logger.info("All tasks were performed! Finishing execution!")
+    if codeml_results is not None:
+        codeml_results.wait()
+        # Testes de razão de verossimilhança (M0/M3, M1/M2 e M7/M8) de todos os genes
+        logger.info(f"CodeML LRTs saved to {codeml_results.summarize()}.")
+    if hyphy_store is not None:
+        hyphy_store.wait()
+        # Uma nova execução na mesma pasta substitui as entradas dos genes executados novamente
+        hyphy_store.compact()
+        logger.info(f"HyPhy site and branch tables saved to {hyphy_store.root}.")
+    if trace is not None and len(read_trace(trace)) > 0:
+        logger.info("Resources used by the tasks:\n" + report(read_trace(trace)))
     parsl.dfk().cleanup()
+    # Registro de núcleos desta execução no nó do workflow (nos nós do SLURM, /dev/shm é limpo ao fim do job)
+    shutil.rmtree(ledger_dir(), ignore_errors=True)
 
     # Aguardar resultados
 
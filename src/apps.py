@@ -1,13 +1,52 @@
 import os, parsl, logging, re
-from parsl.data_provider.files import File
-from parsl import bash_app, python_app
+from parsl import bash_app
 
 logger = logging.getLogger()
 
+# Arquivos gerados pelo RAxML para cada execução (RAxML_<tipo>.<prefixo>_output.tree)
+RAXML_OUTPUTS = ["result", "info", "log", "bestTree", "parsimonyTree"]
+
 @bash_app
-def mafft(executables, multithread_parameter, infile, outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
-    logger.info(f"Running MAFFT on {infile} with {multithread_parameter} threads.")
-    return f'{executables["mafft"]} --thread {multithread_parameter} --auto --phylipout --inputorder {infile} > {outputs[0]}'
+def mafft(executables, multithread_parameter, infile, prefix="", cache_dir=None, node_cpus=None, trace=None, collapse=None, shards=None, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    from runner import runner_command, THREADS_PLACEHOLDER
+    logger.info(f"Running MAFFT on {infile} with up to {multithread_parameter} threads.")
+    # O diretório de saída do arquivo é criado pelo próprio worker
+    os.makedirs(os.path.dirname(outputs[0].filepath), exist_ok=True)
+    options = "--auto --phylipout --inputorder"
+    output_dir, output_name = os.path.split(outputs[0].filepath)
+    alignment = outputs[0].filepath
+    names = [output_name]
+    if collapse is not None:
+        # O alinhamento completo fica em <prefixo>.full.mafft e outputs[0] recebe um representante
+        # de cada grupo de sequências idênticas (ou a até `collapse` sítios de distância)
+        from collapse import collapse_command, full_alignment, mapping_file
+        alignment = full_alignment(outputs[0].filepath)
+        names = [os.path.basename(alignment), output_name, os.path.basename(mapping_file(outputs[0].filepath))]
+    command = runner_command(f'{executables["mafft"]} --thread {THREADS_PLACEHOLDER} {options} {infile} > {alignment}',
+                             threads=multithread_parameter, node_cpus=node_cpus, trace=trace,
+                             task=dict(gene=output_dir, tool="mafft"))
+    if collapse is not None:
+        command += " && " + collapse_command(alignment, outputs[0].filepath, mapping_file(outputs[0].filepath), collapse)
+    if cache_dir is not None:
+        from cache import ArtifactCache, cache_key, store_command
+        # O número de threads não altera o alinhamento, então fica fora da chave
+        params = {"options": options}
+        if collapse is not None:
+            params["collapse"] = collapse
+        key = cache_key("mafft", executables["mafft"], files=[infile], params=params)
+        if ArtifactCache(cache_dir).restore(key, output_dir, prefix):
+            command = f"echo 'MAFFT restored from cache ({key})'"
+        else:
+            command += " && " + store_command(cache_dir, key, "mafft", output_dir, prefix, names=names)
+    if shards:
+        # Partições do alinhamento (shards/<nome>/<prefixo>.mafft), recortadas também quando ele vem do cache
+        from shards import shard_command
+        command += " && " + shard_command(outputs[0].filepath, output_dir, prefix, shards, formatted=len(outputs) > 1)
+    # A formatação do phylip para o CodeML (outputs[1], opcional) é feita na mesma tarefa
+    if len(outputs) > 1:
+        from format_phylip import format_command
+        command += " && " + format_command(outputs[0], outputs[1])
+    return command
 
 
 @bash_app
@@ -16,43 +55,88 @@ def readseq(executables, infile, prefix, outputs=[], stdout = parsl.AUTO_LOGNAME
     return f'java -jar {executables["readseq"]} -all -f=12 {infile} -o {outputs[0]}'
 
 
-@python_app
-def format_phylip(infile, prefix, outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
-    from format_phylip import post_process_phylip
-    logger.info(f"Formatting Phylip file {infile} with prefix {prefix}.")
-    post_process_phylip(infile, outputs[0])
-    return
-
 @bash_app
-def raxml(executables, infile, prefix, seed, outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+def raxml(executables, infile, prefix, seed, threads=1, cache_dir=None, node_cpus=None, trace=None, search=None, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    from runner import runner_command, THREADS_PLACEHOLDER
     output_dir = str(outputs[0].url).rsplit('/', 1)[0]
+    task = dict(gene=output_dir, tool="raxml")
+    if search is not None:
+        # Uma das buscas com sementes diferentes, em gene/raxml_searches/seed<semente>
+        os.makedirs(output_dir, exist_ok=True)
+        task = dict(gene=os.path.dirname(os.path.dirname(output_dir)), tool="raxml", start=search)
     logger.info(f"Running RAxML on {infile} with prefix {prefix} and seed {seed}.")
-    return f'{executables["raxml"]} -s {infile} -m GTRCAT -n {prefix}_output.tree -w {output_dir} -p {seed}'
-
-@python_app
-def format_tree(infile, prefix, outputs=[], stdout = parsl.AUTO_LOGNAME, stderr = parsl.AUTO_LOGNAME):
-    import os
-     # corrigir erro do tree_file adicionando 1 e removendo a nova linha do final
-    logger.info(f"Formatting RAxML tree {infile} with prefix {prefix}.")
-    content = ""
-    with open(infile.filepath, 'r') as t_file:
-        content = t_file.read()
-    with open(outputs[0], "w+") as n_file:
-        line = "1"
-        n_file.write(line.rstrip('\r\n') + '\n' + content.rstrip('\r\n'))
-    return
+    # A versão PTHREADS do RAxML exige pelo menos 2 threads
+    binary = executables["raxml"]
+    options = ""
+    min_threads = 1
+    if threads > 1 and "raxml_pthreads" in executables:
+        binary = executables["raxml_pthreads"]
+        options = f" -T {THREADS_PLACEHOLDER}"
+        min_threads = 2
+    else:
+        threads = 1
+    command = runner_command(f'{binary} -s {infile} -m GTRCAT -n {prefix}_output.tree -w {output_dir} -p {seed}{options}',
+                             threads=threads, min_threads=min_threads, node_cpus=node_cpus, trace=trace, task=task)
+    if cache_dir is not None:
+        from cache import ArtifactCache, cache_key, store_command
+        key = cache_key("raxml", binary, files=[infile], params={"model": "GTRCAT", "seed": seed})
+        if ArtifactCache(cache_dir).restore(key, output_dir, prefix):
+            command = f"echo 'RAxML restored from cache ({key})'"
+        else:
+            names = [f"RAxML_{kind}.{prefix}_output.tree" for kind in RAXML_OUTPUTS]
+            command += " && " + store_command(cache_dir, key, "raxml", output_dir, prefix, names=names)
+    # A formatação da árvore para o CodeML (outputs[1], opcional) é feita na mesma tarefa
+    if len(outputs) > 1:
+        from format_phylip import format_command
+        command += " && " + format_command(outputs[0], outputs[1], tree=True)
+    return command
+
 @bash_app
-def codeml(executables, infile, treefile, prefix, model, dir_outputs, outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
-    
+def raxml_best(prefix, searches, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    # Copia para o diretório do gene a árvore da busca com a maior verossimilhança (inputs são as buscas)
+    from tree_search import best_command
+    command = best_command(searches, os.path.dirname(outputs[0].filepath), prefix)
+    # A formatação da árvore para o CodeML (outputs[1], opcional) é feita na mesma tarefa
+    if len(outputs) > 1:
+        from format_phylip import format_command
+        command += " && " + format_command(outputs[0], outputs[1], tree=True)
+    return command
+
+def codeml_command(executables, infile, treefile, prefix, model, dir_outputs, cache_dir=None, node_cpus=None, scratch=None, keep=None, trace=None,
+                   start=None, initial=None, stop_marker=None, shard=None):
+    # Prepara o diretório e o .ctl do modelo e retorna o comando do codeml (usado pelo app codeml e pelos bundles)
+    from scratch import SCRATCH_PLACEHOLDER, scratch_command
+    from multistart import set_initial, start_dir, start_command
+    from shards import shard_dir
+    infile = getattr(infile, "filepath", infile)
+    treefile = getattr(treefile, "filepath", treefile)
+    # No modo scratch o codeml executa em um diretório local do nó, com cópias das entradas
+    work_dir = SCRATCH_PLACEHOLDER
+    seqfile_path = os.path.join(work_dir, os.path.basename(infile))
+    treefile_path = os.path.join(work_dir, os.path.basename(treefile))
+
     # Pega o diretório de saída do argumento da linha de comando (sys.argv[3])
     print(f"Diretório de saída (dir_outputs): {dir_outputs}")  # Depuração para verificar o diretório correto
 
     # Subdiretório específico para o modelo (ex: M0, M1, ...)
     model_output_dir = os.path.join(dir_outputs, model)  # Garantir que o diretório do modelo seja corretamente formado
+    task = dict(gene=str(dir_outputs), tool="codeml", model=model)
+    if shard is not None:
+        # Uma partição do alinhamento do gene, com a mesma árvore (ex: shards/E/M8)
+        model_output_dir = os.path.join(shard_dir(dir_outputs, shard), model)
+        task["shard"] = shard
     print(f"model_output_dir: {model_output_dir}")  # Depuração do diretório do modelo
+    # Cada ponto de partida do multi-start executa em seu próprio subdiretório do modelo (ex: M8/start2)
+    if start is not None:
+        model_output_dir = start_dir(model_output_dir, start)
+        task["start"] = start
 
-    # Garantir que o diretório específico do modelo seja criado
-    os.makedirs(model_output_dir, exist_ok=True)
+    # Garantir que o diretório específico do modelo seja criado (no modo scratch, apenas na cópia das saídas)
+    if scratch is None:
+        os.makedirs(model_output_dir, exist_ok=True)
+        work_dir = model_output_dir
+        seqfile_path = infile
+        treefile_path = treefile
 
     # Caminho para o arquivo .ctl (será gravado no subdiretório do modelo)
     ctl_template_path = f'./scripts/{model}/codeml.ctl'
@@ -60,10 +144,11 @@ def codeml(executables, infile, treefile, prefix, model, dir_outputs, outputs=[]
 
     # Ler o template e substituir as variáveis no arquivo .ctl
     with open(ctl_template_path, 'r') as ctl_file:
-        ctl_content = ctl_file.read()
+        ctl_template = ctl_file.read()
+    ctl_content = ctl_template
 
     # Substituir o caminho do arquivo Phylip
-    ctl_content = ctl_content.replace("%=FASTA_FILE%-f.phylip", infile.filepath)  # Substituir o arquivo Phylip
+    ctl_content = ctl_content.replace("%=FASTA_FILE%-f.phylip", seqfile_path)  # Substituir o arquivo Phylip
 
     # Ajustar o caminho do 'treefile' para o formato correto, mas no diretório geral
     #fixed_treefile = os.path.join(dir_outputs, f"RAxML_result.{prefix}_output.tree")  # Caminho correto para o treefile
@@ -72,36 +157,76 @@ def codeml(executables, infile, treefile, prefix, model, dir_outputs, outputs=[]
     # Substituir o campo 'treefile' no arquivo .ctl
     ctl_content = re.sub(
         r"treefile\s*=\s*.*",  # Localizar a linha específica de "treefile"
-        f"treefile = {treefile.filepath}",  # Substituir com o caminho fixo para o treefile
+        f"treefile = {treefile_path}",  # Substituir com o caminho fixo para o treefile
         ctl_content
     )
     # Corrigir o campo "outfile" com o formato correto
-    outfile_path = os.path.join(model_output_dir, f"{model}_{prefix}.results.txt")  # Caminho correto para o outfile
+    outfile_path = os.path.join(work_dir, f"{model}_{prefix}.results.txt")  # Caminho correto para o outfile
     print(f"outfile_path: {outfile_path}")  # Depuração do caminho do outfile
     ctl_content = re.sub(
         r"outfile\s*=\s*.*",  # Localizar linha de "outfile"
         f"outfile = {outfile_path}   * main result file name",
         ctl_content
     )
-    # Escrever o novo arquivo .ctl no diretório do modelo
-    with open(new_ctl_path, 'w') as new_ctl_file:
-        new_ctl_file.write(ctl_content)
-
+    # Valores iniciais de omega e kappa do ponto de partida (o primeiro usa os do template)
+    ctl_content = set_initial(ctl_content, initial or {})
     # Retornar o comando para execução do codeml
-    return f"cd {model_output_dir} && {executables['codeml']} codeml.ctl"
+    from runner import runner_command
+    command = runner_command(f"{executables['codeml']} codeml.ctl", node_cpus=node_cpus, trace=trace, task=task)
+    if scratch is None:
+        # Escrever o novo arquivo .ctl no diretório do modelo
+        with open(new_ctl_path, 'w') as new_ctl_file:
+            new_ctl_file.write(ctl_content)
+        command = f"cd {model_output_dir} && " + command
+    else:
+        # O .ctl é escrito diretamente no scratch, sem criar arquivos no sistema de arquivos compartilhado
+        command = scratch_command(f"cat > codeml.ctl <<'CTL'\n{ctl_content}\nCTL\n{command}", scratch, model_output_dir,
+                                  stage=[infile, treefile], keep=keep)
+    if cache_dir is not None:
+        from cache import ArtifactCache, cache_key, store_command
+        # A chave usa o template (sem os caminhos do gene) e o conteúdo das entradas
+        params = {"model": model, "ctl": ctl_template}
+        if initial:
+            params["initial"] = initial
+        key = cache_key("codeml", executables["codeml"], files=[infile, treefile], params=params)
+        if ArtifactCache(cache_dir).restore(key, model_output_dir, prefix):
+            return f"echo 'CodeML {model} restored from cache ({key})'"
+        command += " && " + store_command(cache_dir, key, "codeml", model_output_dir, prefix, exclude=["codeml.ctl"])
+    if start is not None:
+        # O ponto de partida remove o resultado de uma execução anterior e não executa se o melhor lnL do modelo já convergiu
+        command = start_command(os.path.join(model_output_dir, f"{model}_{prefix}.results.txt"), stop_marker, command)
+    return command
+
+def hyphy_command(executables, infile, treefile, prefix, model, dir_outputs, threads=1, cache_dir=None, node_cpus=None, scratch=None, keep=None, trace=None,
+                  shard=None):
+    # Prepara o diretório e o .ctl do modelo e retorna o comando do hyphy (usado pelo app hyphy e pelos bundles)
+    from scratch import SCRATCH_PLACEHOLDER, scratch_command
+    from shards import shard_dir
+    infile = getattr(infile, "filepath", infile)
+    treefile = getattr(treefile, "filepath", treefile)
+    # No modo scratch o hyphy executa em um diretório local do nó, com cópias das entradas
+    work_dir = SCRATCH_PLACEHOLDER
+    seqfile_path = os.path.join(work_dir, os.path.basename(infile))
+    treefile_path = os.path.join(work_dir, os.path.basename(treefile))
 
-@bash_app
-def hyphy(executables, infile, treefile, prefix, model, dir_outputs, outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
-    
     # Pega o diretório de saída do argumento da linha de comando (sys.argv[3])
     print(f"Diretório de saída (dir_outputs): {dir_outputs}")  # Depuração para verificar o diretório correto
 
     # Subdiretório específico para o modelo (ex: ny, meme, slac, fubar, fel, absrel)
     model_output_dir = os.path.join(dir_outputs, model)  # Garantir que o diretório do modelo seja corretamente formado
+    task = dict(gene=str(dir_outputs), tool="hyphy", model=model)
+    if shard is not None:
+        # Uma partição do alinhamento do gene, com a mesma árvore (ex: shards/E/meme)
+        model_output_dir = os.path.join(shard_dir(dir_outputs, shard), model)
+        task["shard"] = shard
     print(f"model_output_dir: {model_output_dir}")  # Depuração do diretório do modelo
 
-    # Garantir que o diretório específico do modelo seja criado
-    os.makedirs(model_output_dir, exist_ok=True)
+    # Garantir que o diretório específico do modelo seja criado (no modo scratch, apenas na cópia das saídas)
+    if scratch is None:
+        os.makedirs(model_output_dir, exist_ok=True)
+        work_dir = model_output_dir
+        seqfile_path = infile
+        treefile_path = treefile
 
     # Caminho para o arquivo .ctl (será gravado no subdiretório do modelo)
     ctl_template_path = f'./scripts/{model}/hyphy.ctl'
@@ -109,16 +234,17 @@ def hyphy(executables, infile, treefile, prefix, model, dir_outputs, outputs=[],
 
     # Ler o template e substituir as variáveis no arquivo .ctl
     with open(ctl_template_path, 'r') as ctl_file:
-        ctl_content = ctl_file.read()
+        ctl_template = ctl_file.read()
+    ctl_content = ctl_template
 
     # Substituir o caminho do arquivo Phylip
-    ctl_content = ctl_content.replace("%=FASTA_FILE%.phylip", infile.filepath)  # Substituir o arquivo Phylip
+    ctl_content = ctl_content.replace("%=FASTA_FILE%.phylip", seqfile_path)  # Substituir o arquivo Phylip
 
     # Ajustar o caminho do 'treefile' para o formato correto, mas no diretório geral
     #fixed_treefile = os.path.join(dir_outputs, f"RAxML_result.{prefix}_output.tree")  # Caminho correto para o treefile
     #print(f"fixed_treefile: {fixed_treefile}")  # Depuração do caminho do treefile
 
-    ctl_content = ctl_content.replace("RAxML_result.%=FASTA_FILE%.tree", treefile.filepath)  # Substituir o arquivo Raxml
+    ctl_content = ctl_content.replace("RAxML_result.%=FASTA_FILE%.tree", treefile_path)  # Substituir o arquivo Raxml
 
     # Substituir o campo 'treefile' no arquivo .ctl
     #ctl_content = re.sub(
@@ -128,7 +254,7 @@ def hyphy(executables, infile, treefile, prefix, model, dir_outputs, outputs=[],
     #)
 
     # Corrigir o campo "outfile" com o formato correto
-    outfile_path = os.path.join(model_output_dir, f"{model}_{prefix}.results.json")  # Caminho correto para o outfile
+    outfile_path = os.path.join(work_dir, f"{model}_{prefix}.results.json")  # Caminho correto para o outfile
     print(f"outfile_path: {outfile_path}")  # Depuração do caminho do outfile
     ctl_content = ctl_content.replace("outfile_result.%=FASTA_FILE%", outfile_path)  # Substituir o arquivo Raxml
 
@@ -138,9 +264,65 @@ def hyphy(executables, infile, treefile, prefix, model, dir_outputs, outputs=[],
     #    ctl_content
     #)
     
-    # Escrever o novo arquivo .ctl no diretório do modelo
-    with open(new_ctl_path, 'w') as new_ctl_file:
-        new_ctl_file.write(ctl_content)
-
     # Retornar o comando para execução do hyphy
-    return f"cd {model_output_dir} && {executables['hyphy']} -i < hyphy.ctl"
\ No newline at end of file
+    from runner import runner_command, THREADS_PLACEHOLDER
+    command = runner_command(f"{executables['hyphy']} CPU={THREADS_PLACEHOLDER} -i < hyphy.ctl",
+                             threads=threads, node_cpus=node_cpus, trace=trace, task=task)
+    if scratch is None:
+        # Escrever o novo arquivo .ctl no diretório do modelo
+        with open(new_ctl_path, 'w') as new_ctl_file:
+            new_ctl_file.write(ctl_content)
+        command = f"cd {model_output_dir} && " + command
+    else:
+        # O .ctl é escrito diretamente no scratch, sem criar arquivos no sistema de arquivos compartilhado
+        command = scratch_command(f"cat > hyphy.ctl <<'CTL'\n{ctl_content}\nCTL\n{command}", scratch, model_output_dir,
+                                  stage=[infile, treefile], keep=keep)
+    if cache_dir is not None:
+        from cache import ArtifactCache, cache_key, store_command
+        key = cache_key("hyphy", executables["hyphy"], files=[infile, treefile],
+                        params={"model": model, "ctl": ctl_template})
+        if ArtifactCache(cache_dir).restore(key, model_output_dir, prefix):
+            return f"echo 'HyPhy {model} restored from cache ({key})'"
+        command += " && " + store_command(cache_dir, key, "hyphy", model_output_dir, prefix, exclude=["hyphy.ctl"])
+    return command
+
+@bash_app
+def codeml(executables, infile, treefile, prefix, model, dir_outputs, cache_dir=None, node_cpus=None, scratch=None, keep=None, trace=None, start=None, initial=None, stop_marker=None, shard=None, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    return codeml_command(executables, infile, treefile, prefix, model, dir_outputs, cache_dir=cache_dir, node_cpus=node_cpus,
+                          scratch=scratch, keep=keep, trace=trace, start=start, initial=initial, stop_marker=stop_marker,
+                          shard=shard)
+
+@bash_app
+def hyphy(executables, infile, treefile, prefix, model, dir_outputs, threads=1, cache_dir=None, node_cpus=None, scratch=None, keep=None, trace=None, shard=None, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    return hyphy_command(executables, infile, treefile, prefix, model, dir_outputs, threads=threads, cache_dir=cache_dir, node_cpus=node_cpus,
+                         scratch=scratch, keep=keep, trace=trace, shard=shard)
+
+@bash_app
+def bundle(executables, jobs, workers=1, cache_dir=None, node_cpus=None, scratch=None, keep=None, trace=None, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    # Executa vários pares (gene, modelo) do codeml/hyphy em uma única tarefa; o resultado de cada par vai para outputs[0]
+    from bundle import bundle_command
+    commands = dict()
+    for job in jobs:
+        if job["tool"] == "codeml":
+            command = codeml_command(executables, job["infile"], job["treefile"], job["prefix"], job["model"],
+                                     job["dir_outputs"], cache_dir=cache_dir, node_cpus=node_cpus,
+                                     scratch=scratch, keep=keep, trace=trace, start=job.get("start"),
+                                     initial=job.get("initial"), stop_marker=job.get("stop_marker"),
+                                     shard=job.get("shard"))
+        else:
+            command = hyphy_command(executables, job["infile"], job["treefile"], job["prefix"], job["model"],
+                                    job["dir_outputs"], threads=job.get("threads", 1), cache_dir=cache_dir,
+                                    node_cpus=node_cpus, scratch=scratch, keep=keep, trace=trace,
+                                    shard=job.get("shard"))
+        # stdout/stderr do par no diretório do seu gene (--archive), ou nos da tarefa do bundle
+        commands[job["id"]] = dict(command=command, stdout=job.get("stdout"), stderr=job.get("stderr"))
+    logger.info(f"Running a bundle of {len(jobs)} tasks with {workers} workers.")
+    return bundle_command(commands, outputs[0].filepath, workers)
+
+@bash_app
+def pack(archive_dir, gene_dir, gene, inputs=[], outputs=[], stdout = parsl.AUTO_LOGNAME, stderr=parsl.AUTO_LOGNAME):
+    # Coletor de um arquivo: acrescenta as saídas do gene aos pacotes do arquivo compactado e remove o
+    # diretório temporário (inputs é concluído quando todas as tarefas do gene terminam, mesmo com falhas)
+    from archive import pack_command
+    logger.info(f"Packing {gene} into {archive_dir}.")
+    return pack_command(archive_dir, gene_dir, gene, remove=True)
@@ -0,0 +1,298 @@
+import os
+import sys
+import csv
+import time
+import shlex
+import socket
+import shutil
+import tarfile
+import argparse
+from planner import CODEML_WEIGHTS, HYPHY_WEIGHTS
+from tree_search import SEARCHES_FILE
+
+# generation identifies the collector that packed the row: a gene packed again replaces all its files
+INDEX_COLUMNS = ["gene", "tool", "model", "name", "pack", "offset", "size", "generation"]
+# A new pack is started once the current one reaches this size
+PACK_BYTES = 4 << 30
+CHUNK_SIZE = 1 << 20
+# Folder of the gene with the stdout/stderr of its tasks (<tool>[.<model>][.start<n>].stdout)
+LOGS_DIR = "logs"
+# A lock of another node older than this (seconds) is taken as left by a collector that died
+LOCK_TIMEOUT = 3600
+
+
+def member_tool(name):
+    # Tool and model of a file of a gene folder (path relative to the folder, with /)
+    parts = name.split("/")
+    if len(parts) > 1 and parts[-2] == LOGS_DIR:
+        fields = parts[-1].split(".")
+        return fields[0], fields[1] if len(fields) > 2 and (fields[1] in CODEML_WEIGHTS or fields[1] in HYPHY_WEIGHTS) else ""
+    for part in parts[:-1]:
+        if part in CODEML_WEIGHTS:
+            return "codeml", part
+        if part in HYPHY_WEIGHTS:
+            return "hyphy", part
+    if parts[0] == "raxml_searches" or parts[-1] == SEARCHES_FILE or parts[-1].startswith("RAxML_"):
+        return "raxml", ""
+    return "mafft", ""
+
+
+def blocks(size):
+    # Bytes taken by a file of `size` bytes in a tar, padded to its blocks
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class ArchiveLock:
+    # Lock file created with O_EXCL, which is atomic on the shared file systems (NFS, Lustre)
+    # where flock may be local to the node or a no-op. It holds the host and the PID of the
+    # collector, so the lock of a collector that died in the same node is taken over at once.
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def _stale(self, path):
+        # Identity (inode, mtime and content) of the lock when it is stale, otherwise None
+        try:
+            st = os.stat(path)
+            with open(path, 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        identity = (st.st_ino, st.st_mtime_ns, content)
+        old = time.time() - st.st_mtime > self.timeout
+        try:
+            host, pid = content.split()
+        except ValueError:
+            # Lock being written by its collector, unless it was left empty long ago
+            return identity if old else None
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return identity
+            except (OSError, ValueError):
+                pass
+        return identity if old else None
+
+    def _take_over(self):
+        # Moves a stale lock aside under a name of this collector and removes it only if it is still
+        # the lock found stale: another collector may have replaced it by a fresh lock in between,
+        # which is put back (os.link does not overwrite a lock created meanwhile)
+        identity = self._stale(self.path)
+        if identity is None:
+            return False
+        aside = f"{self.path}.{socket.gethostname()}.{os.getpid()}"
+        try:
+            os.rename(self.path, aside)
+        except FileNotFoundError:
+            return True
+        try:
+            st = os.stat(aside)
+            with open(aside, 'r') as f:
+                moved = (st.st_ino, st.st_mtime_ns, f.read())
+            if moved != identity:
+                try:
+                    os.link(aside, self.path)
+                except FileExistsError:
+                    pass
+        finally:
+            os.remove(aside)
+        return True
+
+    def __enter__(self):
+        delay = 0.05
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if self._take_over():
+                    continue
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{socket.gethostname()} {os.getpid()}\n")
+            return self
+
+    def __exit__(self, *exc):
+        os.remove(self.path)
+
+
+def log_files(gene_dir, *name):
+    # stdout/stderr of a task kept in the gene folder, so they are packed with its outputs
+    base = os.path.join(gene_dir, LOGS_DIR, ".".join(str(n) for n in name if n not in (None, "")))
+    return dict(stdout=f"{base}.stdout", stderr=f"{base}.stderr")
+
+
+class Archive:
+    # Outputs of the genes appended to a few uncompressed tar files (pack-<n>.tar), so a run
+    # leaves a handful of files instead of a folder per gene. index.tsv gives the pack, the
+    # offset and the size of the content of each file, so one file is read with a single seek.
+    def __init__(self, root, pack_bytes=PACK_BYTES):
+        self.root = root
+        self.pack_bytes = pack_bytes
+        self.index_file = os.path.join(root, "index.tsv")
+        self.lock_file = os.path.join(root, ".lock")
+
+    def pack_file(self, n):
+        return os.path.join(self.root, f"pack-{n:04d}.tar")
+
+    def _current_pack(self):
+        n = 0
+        while os.path.exists(self.pack_file(n + 1)):
+            n += 1
+        if os.path.exists(self.pack_file(n)) and os.path.getsize(self.pack_file(n)) >= self.pack_bytes:
+            n += 1
+        return n
+
+    def _end(self, n):
+        # End of the last file of pack n. Only the current pack is appended to, so it is given by
+        # the last line of the index; the end marker of tar (and a partial append) is overwritten
+        if not os.path.exists(self.index_file):
+            return 0
+        with open(self.index_file, 'rb') as f:
+            f.seek(max(0, os.path.getsize(self.index_file) - 65536))
+            lines = f.read().decode().splitlines()
+        last = dict(zip(INDEX_COLUMNS, lines[-1].split("\t"))) if len(lines) > 0 else {}
+        if last.get("pack") != str(n):
+            return 0
+        return int(last["offset"]) + blocks(int(last["size"]))
+
+    def add(self, gene_dir, gene):
+        # Appends the files of a gene folder to the current pack. The lock serializes the
+        # collector tasks of all the nodes, which append to the same pack and index.
+        names = []
+        for directory, _, files in os.walk(gene_dir):
+            for name in files:
+                names.append(os.path.relpath(os.path.join(directory, name), gene_dir).replace(os.sep, "/"))
+        os.makedirs(self.root, exist_ok=True)
+        with ArchiveLock(self.lock_file):
+            generation = f"{time.time_ns()}-{socket.gethostname()}-{os.getpid()}"
+            n = self._current_pack()
+            rows = []
+            with open(self.pack_file(n), 'r+b' if os.path.exists(self.pack_file(n)) else 'wb') as f:
+                f.seek(self._end(n))
+                f.truncate()
+                # A tar written from the current position: the offsets of the TarFile are the offsets of the pack
+                with tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT) as tar:
+                    for name in sorted(names):
+                        path = os.path.join(gene_dir, name)
+                        info = tar.gettarinfo(path, arcname=f"{gene}/{name}")
+                        if not info.isfile():
+                            continue
+                        with open(path, 'rb') as member:
+                            tar.addfile(info, member)
+                        # The content ends at the current offset, padded to the 512 bytes blocks of tar
+                        rows.append([gene, *member_tool(name), name, n, tar.offset - blocks(info.size), info.size, generation])
+            new = not os.path.exists(self.index_file)
+            with open(self.index_file, 'a', newline='') as f:
+                writer = csv.writer(f, delimiter='\t')
+                if new:
+                    writer.writerow(INDEX_COLUMNS)
+                writer.writerows(rows)
+        return len(rows)
+
+    def entries(self, gene=None, tool=None, model=None):
+        # Entries of the last generation of each gene: a gene packed again by a rerun replaces all
+        # the files of the previous one, also those the rerun no longer produces. The index is read
+        # with the columns of INDEX_COLUMNS, so an index written before the generations (without
+        # that column) is read as a single generation.
+        latest = dict()
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', newline='') as f:
+                reader = csv.reader(f, delimiter='\t')
+                next(reader, None)
+                for fields in reader:
+                    row = dict(zip(INDEX_COLUMNS, fields))
+                    if gene is not None and row["gene"] != gene:
+                        continue
+                    generation, files = latest.get(row["gene"], (None, None))
+                    if files is None or row.get("generation") != generation:
+                        files = dict()
+                        latest[row["gene"]] = (row.get("generation"), files)
+                    files[row["name"]] = row
+        return [row for _, files in latest.values() for row in files.values()
+                if (tool is None or row["tool"] == tool) and (model is None or row["model"] == model)]
+
+    def stream(self, entry, out):
+        with open(self.pack_file(int(entry["pack"])), 'rb') as f:
+            f.seek(int(entry["offset"]))
+            left = int(entry["size"])
+            while left > 0:
+                chunk = f.read(min(CHUNK_SIZE, left))
+                if len(chunk) == 0:
+                    raise ValueError(f"Pack {entry['pack']} ends before {entry['gene']}/{entry['name']}.")
+                out.write(chunk)
+                left -= len(chunk)
+
+    def entry(self, gene, name):
+        found = [e for e in self.entries(gene) if e["name"] == name]
+        if len(found) == 0:
+            raise KeyError(f"{gene}/{name} is not in {self.root}")
+        return found[0]
+
+    def read(self, gene, name):
+        # Content of one file, without unpacking anything else
+        entry = self.entry(gene, name)
+        with open(self.pack_file(int(entry["pack"])), 'rb') as f:
+            f.seek(int(entry["offset"]))
+            return f.read(int(entry["size"]))
+
+    def extract(self, destination, gene=None):
+        # Rebuilds the folders of the genes (e.g. for results.py or hyphy_store.py build)
+        count = 0
+        for entry in self.entries(gene):
+            path = os.path.join(destination, entry["gene"], *entry["name"].split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as out:
+                self.stream(entry, out)
+            count += 1
+        return count
+
+
+def pack_command(archive_dir, gene_dir, gene, remove=False):
+    # Command of the collector task of a gene, executed after all the tasks of the gene
+    cmd = f"{sys.executable} {os.path.abspath(__file__)} pack {shlex.quote(str(archive_dir))} {shlex.quote(str(gene_dir))} {shlex.quote(gene)}"
+    return cmd + (" --remove" if remove else "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packed archive of the outputs of the genes of a HighSPA run.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Appends the files of a gene folder to the archive.")
+    pack_parser.add_argument("archive", help="Archive folder (output_folder/archive).")
+    pack_parser.add_argument("gene_dir", help="Folder of the gene.")
+    pack_parser.add_argument("gene", help="Name of the gene in the index (its folder relative to the outputs).")
+    pack_parser.add_argument("--remove", help="Removes the folder of the gene once it is packed.", action="store_true")
+    pack_parser.add_argument("--pack-size", help="Size in MB from which a new pack is started.", type=int, default=PACK_BYTES >> 20)
+    list_parser = subparsers.add_parser("list", help="Lists the files of the archive.")
+    list_parser.add_argument("archive", help="Archive folder.")
+    list_parser.add_argument("--gene", help="Only the files of this gene.", default=None)
+    list_parser.add_argument("--tool", help="Only the files of this tool (mafft, raxml, codeml, hyphy).", default=None)
+    list_parser.add_argument("--model", help="Only the files of this model.", default=None)
+    cat_parser = subparsers.add_parser("cat", help="Writes one file of the archive to stdout.")
+    cat_parser.add_argument("archive", help="Archive folder.")
+    cat_parser.add_argument("gene", help="Gene of the file.")
+    cat_parser.add_argument("name", help="Path of the file in the folder of the gene, e.g. M8/M8_gene.results.txt.")
+    extract_parser = subparsers.add_parser("extract", help="Rebuilds the folders of the genes.")
+    extract_parser.add_argument("archive", help="Archive folder.")
+    extract_parser.add_argument("destination", help="Folder that receives the genes.")
+    extract_parser.add_argument("--gene", help="Only this gene.", default=None)
+    args = parser.parse_args()
+    if args.command == "pack":
+        count = Archive(args.archive, args.pack_size << 20).add(args.gene_dir, args.gene)
+        if args.remove:
+            shutil.rmtree(args.gene_dir, ignore_errors=True)
+        print(f"{count} files of {args.gene} packed in {args.archive}")
+    elif args.command == "list":
+        print("\t".join(INDEX_COLUMNS))
+        for entry in Archive(args.archive).entries(args.gene, args.tool, args.model):
+            print("\t".join(entry.get(c, "") for c in INDEX_COLUMNS))
+    elif args.command == "cat":
+        try:
+            entry = Archive(args.archive).entry(args.gene, args.name)
+        except KeyError as e:
+            parser.exit(1, f"{e.args[0]}\n")
+        Archive(args.archive).stream(entry, sys.stdout.buffer)
+    else:
+        print(f"{Archive(args.archive).extract(args.destination, args.gene)} files extracted to {args.destination}")
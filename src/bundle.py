@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import shlex
+import logging
+import argparse
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from streaming import settled
+
+logger = logging.getLogger()
+
+
+class BundleJobError(Exception):
+    pass
+
+
+def failed_dependency(depends):
+    # First exception among the (finished) dependencies of a pair, None if all of them succeeded
+    for future in depends:
+        if future.exception() is not None:
+            return future.exception()
+    return None
+
+
+def run_bundle(jobs_file, status_file, workers=1):
+    # Executes the commands of the bundle and records the exit code of each one,
+    # so a failed (gene, model) pair does not fail the other pairs of the bundle
+    with open(jobs_file, 'r') as f:
+        commands = json.load(f)
+
+    def execute(item):
+        # The stdout/stderr of a pair go to its own files when given (e.g. the logs folder of
+        # its gene with --archive), otherwise to the ones of the bundle
+        job_id, job = item
+        streams = dict()
+        try:
+            for name in ("stdout", "stderr"):
+                if job.get(name):
+                    os.makedirs(os.path.dirname(job[name]), exist_ok=True)
+                    streams[name] = open(job[name], 'a')
+            return job_id, subprocess.call(job["command"], shell=True, executable="/bin/bash", **streams)
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        status = dict(pool.map(execute, commands.items()))
+    tmp = f"{status_file}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp, status_file)
+    os.remove(jobs_file)
+
+
+def bundle_command(commands, status_file, workers=1):
+    # The commands (id -> command, stdout, stderr) are passed through a file next to the status file of the bundle
+    jobs_file = status_file.replace(".status.json", ".jobs.json")
+    os.makedirs(os.path.dirname(status_file), exist_ok=True)
+    with open(jobs_file, 'w') as f:
+        json.dump(commands, f)
+    return (f"{sys.executable} {os.path.abspath(__file__)} --workers {workers} "
+            f"{shlex.quote(jobs_file)} {shlex.quote(status_file)}")
+
+
+class Bundler:
+    # Groups (gene, model) pairs into bundles of `size` pairs submitted as a single task.
+    # Each pair gets its own future, resolved from the status file of its bundle. The bundle
+    # starts once the dependencies of all its pairs finish, and only runs the pairs whose own
+    # dependencies succeeded, so a failed file does not fail the other pairs.
+    def __init__(self, app, size, bundle_dir, **app_kwargs):
+        self.app = app
+        self.size = size
+        self.bundle_dir = bundle_dir
+        self.app_kwargs = app_kwargs
+        self.count = 0
+        self._reset()
+
+    def _reset(self):
+        self.jobs = []
+        self.futures = []
+        self.depends = []
+
+    def add(self, job, depends=[]):
+        # A pair that depends on a pending pair (repeated inputs) cannot share its bundle
+        if any(d in self.futures for d in depends):
+            self.flush()
+        future = Future()
+        job = dict(job, id=str(len(self.jobs)))
+        self.jobs.append(job)
+        self.futures.append(future)
+        self.depends.append(list(depends))
+        if len(self.jobs) >= self.size:
+            self.flush()
+        return future
+
+    def flush(self):
+        if len(self.jobs) == 0:
+            return
+        from parsl.data_provider.files import File
+        self.count += 1
+        status_file = os.path.join(self.bundle_dir, f"bundle-{self.count}.status.json")
+        jobs, futures, depends = self.jobs, self.futures, self.depends
+        # Pairs to execute, known when all the dependencies finished; Parsl passes the result to the app
+        ready = Future()
+        settled([d for pair in depends for d in pair]).add_done_callback(
+            lambda _: ready.set_result([job for job, pair in zip(jobs, depends) if failed_dependency(pair) is None]))
+        app_future = self.app(jobs=ready, outputs=[File(status_file)], **self.app_kwargs)
+        app_future.add_done_callback(lambda f: self._resolve(f, jobs, futures, depends, status_file))
+        self._reset()
+
+    def _resolve(self, app_future, jobs, futures, depends, status_file):
+        error = app_future.exception()
+        status = dict()
+        if error is None:
+            try:
+                with open(status_file, 'r') as f:
+                    status = json.load(f)
+            except (OSError, ValueError) as e:
+                error = e
+        # The jobs file is left by a bundle that did not finish
+        for path in (status_file, status_file.replace(".status.json", ".jobs.json")):
+            if os.path.exists(path):
+                os.remove(path)
+        for job, future, pair in zip(jobs, futures, depends):
+            if failed_dependency(pair) is not None:
+                # Not executed by the bundle: the pair fails with the error of its own dependency
+                future.set_exception(failed_dependency(pair))
+            elif error is not None:
+                future.set_exception(error)
+            elif status.get(job["id"]) == 0:
+                future.set_result(job)
+            else:
+                logger.error(f"{job['tool']} {job['model']} failed for {job['prefix']} (exit code {status.get(job['id'])}).")
+                future.set_exception(BundleJobError(f"{job['tool']} {job['model']} failed for {job['prefix']}"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a bundle of HighSPA tasks.")
+    parser.add_argument("--workers", help="Number of tasks of the bundle executed at the same time.", type=int, default=1)
+    parser.add_argument("jobs_file")
+    parser.add_argument("status_file")
+    args = parser.parse_args()
+    run_bundle(args.jobs_file, args.status_file, args.workers)
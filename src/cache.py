@@ -0,0 +1,152 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+
+logger = logging.getLogger()
+
+# Placeholder used to store file names independently of the gene prefix,
+# following the same convention used by the ctl templates (%=FASTA_FILE%)
+PREFIX_PLACEHOLDER = "%=PREFIX%"
+MANIFEST = "manifest.json"
+CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def executable_fingerprint(executable):
+    # Resolve the binary and use its real path, size and mtime as its version:
+    # asking the tools for a version is not uniform (codeml has no flag for it)
+    path = shutil.which(executable) or executable
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return f"{path}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def cache_key(tool, executable, files=[], params={}):
+    digest = hashlib.sha256()
+    digest.update(tool.encode())
+    digest.update(executable_fingerprint(executable).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for f in files:
+        # Only the contents matter, so identical inputs with different names share the key
+        digest.update(b'\0')
+        hash_file(getattr(f, "filepath", f), digest)
+    return digest.hexdigest()
+
+
+def _to_template(name, prefix):
+    # Only whole-word occurrences, so a prefix like "1" does not rewrite "rst1"
+    if not prefix:
+        return name
+    return re.sub(rf"(?<![A-Za-z0-9]){re.escape(prefix)}(?![A-Za-z0-9])", PREFIX_PLACEHOLDER, name)
+
+
+def _from_template(name, prefix):
+    return name.replace(PREFIX_PLACEHOLDER, prefix) if prefix else name
+
+
+class ArtifactCache:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def lookup(self, key):
+        try:
+            with open(os.path.join(self.entry_path(key), MANIFEST), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def restore(self, key, directory, prefix=""):
+        manifest = self.lookup(key)
+        if manifest is None:
+            return False
+        entry = self.entry_path(key)
+        os.makedirs(directory, exist_ok=True)
+        for stored, template in manifest["files"].items():
+            shutil.copyfile(os.path.join(entry, stored),
+                            os.path.join(directory, _from_template(template, prefix)))
+        logger.info(f"Cache hit for {manifest['tool']} ({key[:12]}), restored to {directory}.")
+        return True
+
+    def store(self, key, tool, directory, prefix="", names=None, exclude=[]):
+        if self.lookup(key) is not None:
+            return
+        if names is None:
+            names = sorted(os.listdir(directory))
+        names = [n for n in names if n not in exclude and os.path.isfile(os.path.join(directory, n))]
+        os.makedirs(os.path.join(self.root, key[:2]), exist_ok=True)
+        # Fill a temporary entry and rename it, so readers never see partial entries
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.join(self.root, key[:2]))
+        try:
+            files = dict()
+            for i, name in enumerate(names):
+                shutil.copyfile(os.path.join(directory, name), os.path.join(tmp, str(i)))
+                files[str(i)] = _to_template(name, prefix)
+            with open(os.path.join(tmp, MANIFEST), 'w') as f:
+                json.dump({"tool": tool, "files": files}, f)
+            os.rename(tmp, self.entry_path(key))
+        except OSError:
+            # Another task stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_cache_seed(cache_dir, default):
+    # The RAxML entries depend on the seed, so a run without --seed reuses the last one
+    seed_file = os.path.join(cache_dir, "seed")
+    try:
+        with open(seed_file, 'r') as f:
+            seed = int(f.read().strip())
+        logger.info(f"Reusing seed {seed} from {seed_file}.")
+        return seed
+    except (OSError, ValueError):
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(seed_file, 'w') as f:
+            f.write(f"{default}\n")
+        return default
+
+
+def store_command(cache_dir, key, tool, directory, prefix="", names=None, exclude=[]):
+    # Command appended to the apps' bash commands to fill the cache after a successful run
+    cmd = (f"{sys.executable} {os.path.abspath(__file__)} store {os.path.abspath(cache_dir)} {key} {tool} "
+           f"{os.path.abspath(directory)}")
+    # The names are positional, so they come before the options
+    if names is not None:
+        cmd += " " + " ".join(names)
+    cmd += f" --prefix '{prefix}'"
+    for name in exclude:
+        cmd += f" --exclude {name}"
+    return cmd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HighSPA artifact cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    store = subparsers.add_parser("store", help="Store the outputs of a task in the cache.")
+    store.add_argument("cache_dir")
+    store.add_argument("key")
+    store.add_argument("tool")
+    store.add_argument("directory")
+    store.add_argument("names", nargs="*")
+    store.add_argument("--prefix", default="")
+    store.add_argument("--exclude", action="append", default=[])
+    args = parser.parse_args()
+    ArtifactCache(args.cache_dir).store(args.key, args.tool, args.directory, prefix=args.prefix,
+                                        names=args.names or None, exclude=args.exclude)
@@ -0,0 +1,158 @@
+import os
+import csv
+import sys
+import shlex
+import hashlib
+import argparse
+
+# RAxML needs at least 4 taxa, so collapsing never leaves fewer representatives
+MIN_TAXA = 4
+MAPPING_COLUMNS = ["taxon", "representative", "differences"]
+
+
+def full_alignment(path):
+    # MAFFT output kept with all the taxa when the alignment used by the workflow is collapsed
+    base, extension = os.path.splitext(path)
+    return f"{base}.full{extension}"
+
+
+def mapping_file(path):
+    return f"{os.path.splitext(path)[0]}.collapsed.tsv"
+
+
+def phylip_lines(f, taxa):
+    # Lines of a sequential or interleaved phylip file (MAFFT --phylipout), after its header, as
+    # (taxon, name, line, residues): the first line of each taxon starts with its name and the
+    # next blocks repeat the taxa in the same order, without names. Blank lines have no taxon.
+    named = 0
+    count = 0
+    for line in f:
+        if len(line.strip()) == 0:
+            yield None, None, line, ""
+        elif named < taxa:
+            fields = line.split(None, 1)
+            named += 1
+            yield named - 1, fields[0], line, "".join(fields[1].split()) if len(fields) > 1 else ""
+        else:
+            yield count % taxa, None, line, "".join(line.split())
+            count += 1
+
+
+def read_alignment(path, keep_sequences=False):
+    # One streaming pass: a hash of each sequence and, for the distance search, the sequence itself
+    names = []
+    with open(path, 'r') as f:
+        taxa, sites = (int(v) for v in f.readline().split()[:2])
+        digests = [hashlib.blake2b(digest_size=16) for _ in range(taxa)]
+        sequences = [[] for _ in range(taxa)] if keep_sequences else None
+        for taxon, name, _, residues in phylip_lines(f, taxa):
+            if taxon is None:
+                continue
+            if name is not None:
+                names.append(name)
+            residues = residues.upper()
+            digests[taxon].update(residues.encode())
+            if keep_sequences:
+                sequences[taxon].append(residues)
+    if keep_sequences:
+        sequences = ["".join(s) for s in sequences]
+    return names, sites, [d.digest() for d in digests], sequences
+
+
+def differences(a, b, limit):
+    count = 0
+    for x, y in zip(a, b):
+        if x != y:
+            count += 1
+            if count > limit:
+                break
+    return count + abs(len(a) - len(b))
+
+
+def cluster(digests, sequences=None, distance=0):
+    # Exact duplicates share the hash of the whole sequence. Within a distance d, two sequences
+    # split in d + 1 segments have at least one identical segment, so only the representatives
+    # sharing the hash of a segment are compared site by site
+    representative = dict()
+    members = dict()
+    segments = dict()
+    for taxon, digest in enumerate(digests):
+        if digest in representative:
+            # An exact copy is as far from the representative as the first occurrence of the sequence
+            members[representative[digest][0]].append((taxon, representative[digest][1]))
+            continue
+        found = None
+        if distance > 0:
+            sequence = sequences[taxon]
+            size = max(1, -(-len(sequence) // (distance + 1)))
+            keys = [(n, sequence[n * size:(n + 1) * size]) for n in range(distance + 1)]
+            candidates = sorted(set(rep for key in keys for rep in segments.get(key, [])))
+            for rep in candidates:
+                count = differences(sequences[rep], sequence, distance)
+                if count <= distance:
+                    found = (rep, count)
+                    break
+        if found is not None:
+            members[found[0]].append((taxon, found[1]))
+            representative[digest] = found
+            continue
+        representative[digest] = (taxon, 0)
+        members[taxon] = [(taxon, 0)]
+        if distance > 0:
+            for key in keys:
+                segments.setdefault(key, []).append(taxon)
+    # Too few representatives for the tree search: the first duplicates become representatives again
+    for rep in list(members):
+        while len(members) < MIN_TAXA and len(members[rep]) > 1:
+            taxon, _ = members[rep].pop()
+            members[taxon] = [(taxon, 0)]
+    return members
+
+
+def write_collapsed(infile, outfile, keep):
+    # Second streaming pass: copies the header and the lines of the representatives only
+    with open(infile, 'r') as f, open(outfile, 'w') as o:
+        taxa, sites = (int(v) for v in f.readline().split()[:2])
+        o.write(f"{len(keep)} {sites}\n")
+        for taxon, _, line, _ in phylip_lines(f, taxa):
+            if taxon is None or taxon in keep:
+                o.write(line)
+
+
+def collapse(infile, outfile, mapping, distance=0):
+    names, _, digests, sequences = read_alignment(infile, keep_sequences=distance > 0)
+    members = cluster(digests, sequences, distance)
+    write_collapsed(infile, outfile, set(members))
+    with open(mapping, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(MAPPING_COLUMNS)
+        for rep in sorted(members):
+            for taxon, count in members[rep]:
+                writer.writerow([names[taxon], names[rep], count])
+    return len(names), len(members)
+
+
+def read_mapping(path):
+    # Taxa represented by each representative, the representative first
+    taxa = dict()
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            taxa.setdefault(row["representative"], []).append(row["taxon"])
+    return taxa
+
+
+def collapse_command(infile, outfile, mapping, distance=0):
+    # Command appended to the MAFFT task, so the rest of the DAG receives the collapsed alignment
+    return (f"{sys.executable} {os.path.abspath(__file__)} --distance {distance} "
+            f"{shlex.quote(str(infile))} {shlex.quote(str(outfile))} {shlex.quote(str(mapping))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collapses identical (or nearly identical) sequences of a phylip alignment.")
+    parser.add_argument("--distance", help="Maximum number of different sites of the sequences collapsed (0: identical).", type=int, default=0)
+    parser.add_argument("infile", help="Phylip alignment (MAFFT --phylipout).")
+    parser.add_argument("outfile", help="Alignment with one representative of each group.")
+    parser.add_argument("mapping", help="Tab separated file with the representative of each taxon.")
+    args = parser.parse_args()
+    total, kept = collapse(args.infile, args.outfile, args.mapping, args.distance)
+    print(f"{kept} of {total} taxa kept in {args.outfile}")
@@ -1,63 +1,165 @@
 from parsl.executors import ThreadPoolExecutor, HighThroughputExecutor
-from parsl.providers import LocalProvider
-from parsl.launchers import SrunLauncher
+from parsl.providers import LocalProvider, SlurmProvider
+from parsl.launchers import SrunLauncher, SingleNodeLauncher
 from parsl.config import Config
 from parsl.monitoring import MonitoringHub
 from parsl.addresses import address_by_hostname, address_by_interface
 import json as js
 import logging
 import shutil
+import shlex
 import os
+from runner import RUN_ID_ENV
 
 logger = logging.getLogger()
 
 
-def gen_config(threads=4, label="local", monitoring=True, slurm=False, environment=None):
+# Configuração usada pelo --onslurm quando nenhum arquivo de executores é informado
+# (blocos srun dentro da alocação: os blocos ociosos liberam núcleos, mas os nós seguem alocados até o fim do job)
+DEFAULT_SLURM_CONFIG = os.path.join(os.path.dirname(os.path.realpath(__file__)), "executors_slurm.json")
+# Apps do workflow que podem ser direcionadas a um executor pelo campo "routes"
+ROUTED_APPS = ["mafft", "raxml", "raxml_best", "codeml", "hyphy", "bundle", "pack"]
+PROVIDERS = {"local": LocalProvider, "slurm": SlurmProvider}
+
+
+def worker_init(environment=None, extra=""):
+    # Ambiente dos workers: arquivo -env, comandos do arquivo de executores e o PYTHONPATH do workflow
+    lines = []
+    if environment is not None:
+        try:
+            with open(environment, 'r') as env_:
+                lines.append(env_.read())
+        except OSError:
+            logger.warning(f"Could not read the environment file {environment}.")
+    if extra:
+        lines.append(extra)
+    workflow_path = os.path.dirname(os.path.realpath(__file__))
+    lines.append(f'export PYTHONPATH=$PYTHONPATH:{workflow_path}')
+    # ID da execução, que separa o registro de núcleos de cada execução nos nós
+    if os.environ.get(RUN_ID_ENV):
+        lines.append(f'export {RUN_ID_ENV}={shlex.quote(os.environ[RUN_ID_ENV])}')
+    return "\n".join(lines)
+
+
+def expand(value):
+    # "$VAR" ou "${VAR}" recebem o valor da variável de ambiente (ex.: $SLURM_NNODES), convertido para número
+    if isinstance(value, dict):
+        return {k: expand(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [expand(v) for v in value]
+    if isinstance(value, str) and value.startswith("$") and " " not in value:
+        name = value.strip("${}")
+        if os.getenv(name) is None:
+            logger.error(f"The environment variable {name} used by the executors configuration is not defined!")
+            exit(1)
+        value = os.getenv(name)
+        return int(value) if value.isdigit() else value
+    return value
+
+
+def load_executors_config(filename):
+    with open(filename, 'r') as f:
+        conf = expand(js.load(f))
+    executors = conf.get("executors", {})
+    if len(executors) == 0:
+        logger.error(f"{filename} has no executors!")
+        exit(1)
+    for name, executor in executors.items():
+        if executor.get("type") not in ("threads", "htex"):
+            logger.error(f"Executor {name} of {filename} must have the type 'threads' or 'htex'.")
+            exit(1)
+        if executor["type"] == "htex" and executor.get("provider", {}).get("type", "local") not in PROVIDERS:
+            logger.error(f"Executor {name} of {filename} must use the provider {' or '.join(PROVIDERS)}.")
+            exit(1)
+    for app, label in conf.get("routes", {}).items():
+        if app not in ROUTED_APPS + ["default"]:
+            logger.error(f"Unknown app {app} in the routes of {filename} (apps: {', '.join(ROUTED_APPS)}).")
+            exit(1)
+        if label not in executors:
+            logger.error(f"The app {app} is routed to {label}, which is not an executor of {filename}!")
+            exit(1)
+    return conf
+
+
+def gen_executor(label, executor, conf, threads, environment):
+    if executor["type"] == "threads":
+        return ThreadPoolExecutor(label=label, max_threads=executor.get("max_threads", threads))
+    # Endereço e portas: os do executor ou os globais do arquivo
+    network = {k: executor.get(k, conf.get(k)) for k in ("address", "interface", "worker_port_range", "interchange_port_range")}
+    if network["address"] is not None:
+        address = network["address"]
+    elif network["interface"] is not None:
+        address = address_by_interface(network["interface"])
+    else:
+        address = address_by_hostname()
+    options = dict()
+    for k in ("worker_port_range", "interchange_port_range"):
+        if network[k] is not None:
+            options[k] = tuple(network[k])
+    provider = dict(executor.get("provider", {}))
+    kind = provider.pop("type", "local")
+    launcher = provider.pop("launcher", None)
+    if launcher is not None:
+        launcher = dict(launcher)
+        provider["launcher"] = SrunLauncher(**launcher) if launcher.pop("type", "srun") == "srun" else SingleNodeLauncher(**launcher)
+    provider["worker_init"] = worker_init(environment, provider.get("worker_init", ""))
+    return HighThroughputExecutor(label=label,
+                                  address=address,
+                                  max_workers_per_node=executor.get("max_workers_per_node", threads),
+                                  cores_per_worker=executor.get("cores_per_worker", 1.0),
+                                  provider=PROVIDERS[kind](**provider),
+                                  **options)
+
+
+def route_apps(conf, apps):
+    # Cada app executa apenas nos executores do seu rótulo; sem rota, usa o "default" (ou qualquer executor)
+    routes = conf.get("routes", {})
+    for name, app in apps.items():
+        label = routes.get(name, routes.get("default"))
+        app.executors = [label] if label is not None else 'all'
+
+
+def gen_config(threads=4, label="local", monitoring=True, slurm=False, environment=None, htex=False, executors=None):
     monitor = None
     if monitoring:
         monitor = MonitoringHub(hub_address=address_by_hostname(),
                                 workflow_name="HighSPA")
-    if slurm == False:
+    if slurm == True and executors is None:
+        executors = load_executors_config(DEFAULT_SLURM_CONFIG)
+    if executors is not None:
+        # Um executor por classe de tarefa; com a estratégia htex_auto_scale os blocos ociosos
+        # por max_idletime segundos são liberados à medida que a fila esvazia
         return Config(
-            executors=[ThreadPoolExecutor(label=label,
-                                          max_threads=threads)],
-            strategy='simple',
-            retries=0,
+            executors=[gen_executor(name, executor, executors, threads, environment)
+                       for name, executor in executors["executors"].items()],
+            strategy=executors.get("strategy", "htex_auto_scale"),
+            max_idletime=executors.get("max_idletime", 120.0),
+            retries=executors.get("retries", 0),
             monitoring=monitor
         )
-    else:
-        worker_init = ""
-        if environment is not None:
-            try:
-                with open(environment, 'r') as env_:
-                    worker_init = env_.read()
-                    workflow_path = os.path.dirname(os.path.realpath(__file__))
-                    worker_init+=f'\nexport PYTHONPATH=$PYTHONPATH:{workflow_path}'
-            except:
-                worker_init = ""
-            
-        n_workers = os.getenv("SLURM_CPUS_ON_NODE")
-        n_nodes = os.getenv("SLURM_NNODES")
+    if htex == True:
+        # HighThroughputExecutor na máquina local (um bloco de workers), sem o SLURM
         return Config(
             executors=[HighThroughputExecutor(label=label,
-                                              address=address_by_interface('ib0'),
-#                                              worker_port_range=(65000, 65500),
-                                              max_workers_per_node=int(
-                                                  n_workers),
+                                              address="127.0.0.1",
+                                              max_workers_per_node=threads,
                                               provider=LocalProvider(
-                                                  nodes_per_block=1,
-                                                  init_blocks=int(n_nodes),
-                                                  max_blocks=int(n_nodes),
+                                                  init_blocks=1,
+                                                  max_blocks=1,
                                                   min_blocks=1,
-                                                  parallelism=1,
-                                                  worker_init=worker_init,
-                                                  launcher=SrunLauncher(
-                                                      overrides=f'-c {n_workers}')
-                                              ),
-                                              interchange_port_range=(65000,65500)
+                                                  worker_init=worker_init())
                                               )],
+            strategy='simple',
+            retries=0,
             monitoring=monitor
         )
+    return Config(
+        executors=[ThreadPoolExecutor(label=label,
+                                      max_threads=threads)],
+        strategy='simple',
+        retries=0,
+        monitoring=monitor
+    )
 
 
 def load_and_check_executables(filename):
@@ -67,13 +169,17 @@ def load_and_check_executables(filename):
         for app, info in executables_tmp.items():
             if (len(info["path"]) == 0):  # App is on path
                 path = shutil.which(info["executable"])
-                if path is None:
+                if path is None and info.get("optional", False):
+                    logger.warning(f"Optional executable {app} not found, it will not be used.")
+                elif path is None:
                     logger.error(f"Failed to find the {app} executable!")
                     exit(1)
                 else:
                     executables[app] = info["executable"]
             else:
-                if os.path.exists(os.path.join(info["path"], info["executable"])) == False:
+                if os.path.exists(os.path.join(info["path"], info["executable"])) == False and info.get("optional", False):
+                    logger.warning(f"Optional executable {app} not found, it will not be used.")
+                elif os.path.exists(os.path.join(info["path"], info["executable"])) == False:
                     logger.error(f"Failed to find the {
                                  app} executable on path {info["path"]}!")
                     exit(1)
@@ -1,16 +1,10 @@
 import sys
 import os
+import shutil
 
-def post_process_phylip(PhylipFile, OutputFile = None):
-    # Abrir o arquivo phylip e ler seu conteúdo
-    try:
-        with open(PhylipFile, "r") as f:
-            phylip = f.read()
-    except IOError as e:
-        raise Exception(f"I/O error: {e}")
-    except Exception as e:
-        raise Exception(f"Unexpected error: {str(e)}")
+CHUNK_SIZE = 1 << 20
 
+def post_process_phylip(PhylipFile, OutputFile = None):
     # Preparar o caminho para o arquivo de saída
     dirname = os.path.dirname(PhylipFile)
     basename = os.path.splitext(PhylipFile)[0]
@@ -20,29 +14,57 @@ def post_process_phylip(PhylipFile, OutputFile = None):
     if OutputFile is None:
         OutputFile = f"{basename}_formatted{extension}"
 
-    # Processar o conteúdo do arquivo
+    # Processar o arquivo em fluxo: apenas a primeira linha é reescrita, o restante é copiado em blocos
     try:
-        with open(OutputFile, "w") as o:
+        with open(PhylipFile, "r") as f, open(OutputFile, "w") as o:
             # Escrever a primeira linha modificada com números
-            lines = phylip.split("\n")
-            firstLine = lines[0]
+            firstLine = f.readline()
             num_sequences, num_characters = firstLine.split()[:2]  # Pega apenas os dois primeiros números
-            
+
             # Escrever a nova primeira linha
             o.write(f"{num_sequences} {num_characters} I\n")
-            
+
             # Escrever o restante do conteúdo (preservando as linhas seguintes)
-            remaining_phylip = "\n".join(lines[1:])  # Remove a primeira linha
-            o.write(remaining_phylip)
-        
+            shutil.copyfileobj(f, o, CHUNK_SIZE)
+
     except IOError as e:
         raise Exception(f"I/O error: {e}")
     except Exception as e:
         raise Exception(f"Unexpected error: {str(e)}")
 
+def post_process_tree(TreeFile, OutputFile):
+    # corrigir erro do tree_file adicionando 1 e removendo a nova linha do final
+    try:
+        with open(TreeFile, "r") as t_file, open(OutputFile, "w") as n_file:
+            n_file.write("1\n")
+            # As quebras de linha do final de cada bloco ficam pendentes até o próximo bloco
+            pending = ""
+            for chunk in iter(lambda: t_file.read(CHUNK_SIZE), ""):
+                content = chunk.rstrip('\r\n')
+                if len(content) > 0:
+                    n_file.write(pending + content)
+                    pending = chunk[len(content):]
+                else:
+                    pending += chunk
+    except IOError as e:
+        raise Exception(f"I/O error: {e}")
+
+def format_command(infile, outfile, tree=False):
+    # Comando anexado às tarefas do MAFFT e do RAxML para formatar as saídas no próprio worker
+    option = "--tree " if tree else ""
+    return f"{sys.executable} {os.path.abspath(__file__)} {option}{infile} {outfile}"
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Uso incorreto. Exemplo: python format_phylip.py arquivo.phylip")
+    args = sys.argv[1:]
+    tree = len(args) > 0 and args[0] == "--tree"
+    if tree:
+        args = args[1:]
+    if len(args) not in (1, 2) or (tree and len(args) != 2):
+        print("Uso incorreto. Exemplo: python format_phylip.py arquivo.phylip [saida.phylip]")
+        print("                        python format_phylip.py --tree arvore.tree saida.tree")
         sys.exit(1)
-    
-    post_process_phylip(sys.argv[1])
+
+    if tree:
+        post_process_tree(args[0], args[1])
+    else:
+        post_process_phylip(*args)
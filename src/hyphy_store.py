@@ -0,0 +1,334 @@
+import os
+import re
+import csv
+import glob
+import json
+import shutil
+import logging
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import numpy as np
+from collapse import read_mapping
+from shards import shard_of, shard_offset
+
+logger = logging.getLogger()
+
+DTYPE = np.dtype("<f4")
+# first_site: codons of the alignment before the shard of the entry (0 for a whole alignment)
+INDEX_COLUMNS = ["gene", "method", "table", "offset", "rows", "names_offset", "first_site"]
+# Column tested by significant_sites for each method and the direction of the test
+# (FUBAR reports a posterior probability of positive selection instead of a p-value)
+SITE_TESTS = {"meme": ("p-value", "<"), "fel": ("p-value", "<"), "slac": ("P [dN/dS > 1]", "<"),
+              "fubar": ("Prob[alpha<beta]", ">")}
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def site_table(data):
+    # MLE content of MEME, FEL, FUBAR and SLAC: one row per site, partitions in order
+    mle = data.get("MLE")
+    if not isinstance(mle, dict) or "headers" not in mle:
+        return [], []
+    columns = [h[0] if isinstance(h, list) else h for h in mle["headers"]]
+    rows = []
+    content = mle.get("content", {})
+    for partition in sorted(content, key=lambda k: int(k) if str(k).isdigit() else 0):
+        part = content[partition]
+        if isinstance(part, dict):
+            # SLAC keeps the sites under by-site, with the ancestral states resolved or averaged
+            part = part.get("by-site", {})
+            part = part.get("RESOLVED", part.get("AVERAGED", []))
+        rows.extend(part)
+    return columns, rows
+
+
+def branch_table(data):
+    # Numeric attributes of each branch (aBSREL p-values and omegas, branch lengths of the other methods)
+    attributes = data.get("branch attributes")
+    if not isinstance(attributes, dict):
+        return [], [], []
+    names, records = [], []
+    for partition in sorted(k for k in attributes if str(k).isdigit()):
+        for name, values in attributes[partition].items():
+            names.append(name)
+            records.append({k: v for k, v in values.items() if isinstance(v, (int, float)) and not isinstance(v, bool)})
+    columns = sorted(set(k for r in records for k in r))
+    return columns, names, records
+
+
+class HyphyStore:
+    # Site and branch tables of the HyPhy results of all the genes, one little-endian float32
+    # file per (method, column), appended as the tasks finish. index.tsv keeps the rows of each
+    # (gene, method), so a query maps only the columns and rows it reads.
+    def __init__(self, root):
+        self.root = root
+        self.index_file = os.path.join(root, "index.tsv")
+        self.schema_file = os.path.join(root, "schema.json")
+        self.lock = threading.Lock()
+        self.pending = set()
+        # The result files are read and converted by a single thread, not by the callbacks of Parsl
+        self.converter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hyphy-store")
+        self.schema = dict()
+        if os.path.exists(self.schema_file):
+            with open(self.schema_file, 'r') as f:
+                self.schema = json.load(f)
+
+    def column_file(self, table, method, n):
+        return os.path.join(self.root, table, method, f"{n}.f4")
+
+    def names_file(self, method):
+        return os.path.join(self.root, "branch", method, "names.txt")
+
+    def _columns(self, table, method, columns):
+        # The first gene of a method defines its columns; later genes are aligned to them
+        known = self.schema.setdefault(method, dict()).setdefault(table, [])
+        if len(known) == 0 and len(columns) > 0:
+            known.extend(columns)
+            os.makedirs(os.path.join(self.root, table, method), exist_ok=True)
+            tmp = f"{self.schema_file}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.schema, f, indent=1)
+            os.replace(tmp, self.schema_file)
+        return known
+
+    def _rows(self, table, method):
+        columns = self.schema.get(method, {}).get(table, [])
+        if len(columns) == 0 or not os.path.exists(self.column_file(table, method, 0)):
+            return 0
+        return os.path.getsize(self.column_file(table, method, 0)) // DTYPE.itemsize
+
+    def _append(self, table, method, columns, values):
+        offset = self._rows(table, method)
+        for n in range(len(columns)):
+            with open(self.column_file(table, method, n), 'ab') as f:
+                np.asarray(values[:, n], dtype=DTYPE).tofile(f)
+        return offset
+
+    def _index(self, entry):
+        new = not os.path.exists(self.index_file)
+        with open(self.index_file, 'a', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            if new:
+                writer.writerow(INDEX_COLUMNS)
+            writer.writerow(entry)
+
+    def add(self, gene, method, result_file, mapping=None, first_site=0):
+        # One result file in memory at a time; only its tables are kept
+        with open(result_file, 'r') as f:
+            data = json.load(f)
+        header, site_rows = site_table(data)
+        branch_columns, names, records = branch_table(data)
+        del data
+        if mapping is not None and os.path.exists(mapping):
+            # Collapsed alignment: the branch of a representative is named after all the taxa it represents
+            taxa = read_mapping(mapping)
+            names = [",".join(taxa.get(name, [name])) for name in names]
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            if len(site_rows) > 0:
+                columns = self._columns("site", method, header)
+                position = {c: n for n, c in enumerate(header)}
+                values = np.full((len(site_rows), len(columns)), np.nan)
+                for n, column in enumerate(columns):
+                    if column in position:
+                        values[:, n] = [number(row[position[column]]) for row in site_rows]
+                offset = self._append("site", method, columns, values)
+                self._index([gene, method, "site", offset, len(site_rows), -1, first_site])
+            if len(records) > 0:
+                columns = self._columns("branch", method, branch_columns)
+                values = np.array([[number(r.get(c)) for c in columns] for r in records]).reshape(len(records), len(columns))
+                offset = self._append("branch", method, columns, values)
+                names_path = self.names_file(method)
+                names_offset = os.path.getsize(names_path) if os.path.exists(names_path) else 0
+                with open(names_path, 'a') as f:
+                    f.write("".join(f"{name}\n" for name in names))
+                self._index([gene, method, "branch", offset, len(records), names_offset, first_site])
+
+    def watch(self, future, gene, method, result_file, mapping=None, first_site=0):
+        # Returns a future resolved once the result is in the store (or could not be read)
+        stored = Future()
+        with self.lock:
+            self.pending.add(stored)
+        stored.add_done_callback(self._settled)
+
+        def convert():
+            try:
+                self.add(gene, method, result_file, mapping, first_site)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not store the HyPhy result {result_file}: {e}")
+            finally:
+                stored.set_result(None)
+
+        def done(f):
+            # Runs in the completion thread of Parsl: only hands the file to the converter
+            if f.exception() is None:
+                self.converter.submit(convert)
+            else:
+                stored.set_result(None)
+        future.add_done_callback(done)
+        return stored
+
+    def _settled(self, stored):
+        # Runs in the converter thread (or in Parsl's, for failed tasks) while wait may be reading the set
+        with self.lock:
+            self.pending.discard(stored)
+
+    def wait(self):
+        # The last result files may still be queued in the converter when Parsl is done
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def compact(self):
+        # Drops the rows of the entries replaced by a rerun: the columns, the branch names and
+        # the index keep only the latest entry of each (gene, method, table), with new offsets.
+        # Must not run while another process appends to the store.
+        if not os.path.exists(self.index_file):
+            return 0
+        with self.lock:
+            with open(self.index_file, 'r', newline='') as f:
+                rows = list(csv.DictReader(f, delimiter='\t'))
+            latest = dict()
+            for row in rows:
+                latest[(row["gene"], row["method"], row["table"])] = row
+            if len(latest) == len(rows):
+                return 0
+            kept = [row for row in rows if latest[(row["gene"], row["method"], row["table"])] is row]
+            for table, method in {(row["table"], row["method"]) for row in kept}:
+                entries = [row for row in kept if (row["table"], row["method"]) == (table, method)]
+                for n in range(len(self.schema.get(method, {}).get(table, []))):
+                    path = self.column_file(table, method, n)
+                    values = np.memmap(path, dtype=DTYPE, mode='r') if os.path.getsize(path) > 0 else np.zeros(0, dtype=DTYPE)
+                    with open(f"{path}.tmp", 'wb') as out:
+                        for row in entries:
+                            start = int(row["offset"])
+                            np.asarray(values[start:start + int(row["rows"])]).tofile(out)
+                    del values
+                    os.replace(f"{path}.tmp", path)
+                if table == "branch":
+                    path = self.names_file(method)
+                    with open(path, 'rb') as f, open(f"{path}.tmp", 'wb') as out:
+                        for row in entries:
+                            f.seek(int(row["names_offset"]))
+                            names = [f.readline() for _ in range(int(row["rows"]))]
+                            row["names_offset"] = out.tell()
+                            out.write(b"".join(names))
+                    os.replace(f"{path}.tmp", path)
+                offset = 0
+                for row in entries:
+                    row["offset"] = offset
+                    offset += int(row["rows"])
+            with open(f"{self.index_file}.tmp", 'w', newline='') as f:
+                writer = csv.writer(f, delimiter='\t')
+                writer.writerow(INDEX_COLUMNS)
+                writer.writerows([row[c] if c != "first_site" else row.get(c) or 0 for c in INDEX_COLUMNS] for row in kept)
+            os.replace(f"{self.index_file}.tmp", self.index_file)
+        return len(rows) - len(kept)
+
+    def entries(self, table="site"):
+        # Latest entry of each (gene, method): the rows of previous runs are left unreferenced
+        latest = dict()
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', newline='') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    if row["table"] == table:
+                        latest[(row["gene"], row["method"])] = (int(row["offset"]), int(row["rows"]), int(row["names_offset"]),
+                                                                int(row.get("first_site") or 0))
+        return latest
+
+    def column(self, table, method, name):
+        # Memory-mapped column of a method; slicing it reads only the pages of the rows used
+        columns = self.schema.get(method, {}).get(table, [])
+        if name not in columns:
+            raise KeyError(f"{method} has no {table} column '{name}' (columns: {', '.join(columns)})")
+        path = self.column_file(table, method, columns.index(name))
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=DTYPE)
+        return np.memmap(path, dtype=DTYPE, mode='r')
+
+    def gene_table(self, gene, method, table="site"):
+        # All the columns of a (gene, method) as a dict of arrays; the site table also has the codon
+        # of each row in the whole alignment ("site", shifted by first_site for a shard)
+        entry = self.entries(table).get((gene, method))
+        if entry is None:
+            return None
+        offset, rows, names_offset, first_site = entry
+        result = {name: np.array(self.column(table, method, name)[offset:offset + rows])
+                  for name in self.schema[method][table]}
+        if table == "site":
+            result["site"] = np.arange(1, rows + 1) + first_site
+        if table == "branch":
+            with open(self.names_file(method), 'r') as f:
+                f.seek(names_offset)
+                result["name"] = [f.readline().rstrip('\n') for _ in range(rows)]
+        return result
+
+    def significant_sites(self, alpha=0.05, posterior=0.9, methods=None, min_methods=1):
+        # Sites of each gene detected by at least min_methods methods, numbered in the whole alignment
+        found = dict()
+        entries = self.entries("site")
+        for method, (name, direction) in SITE_TESTS.items():
+            if methods is not None and method not in methods:
+                continue
+            if name not in self.schema.get(method, {}).get("site", []):
+                continue
+            values = self.column("site", method, name)
+            for (gene, m), (offset, rows, _, first_site) in entries.items():
+                if m != method:
+                    continue
+                block = values[offset:offset + rows]
+                hits = np.nonzero(block < alpha if direction == "<" else block > posterior)[0]
+                for site in hits + 1 + first_site:
+                    found.setdefault((gene, int(site)), []).append(method)
+        return {k: v for k, v in sorted(found.items()) if len(v) >= min_methods}
+
+
+def build(output_dir, root=None):
+    # Rebuilds the store from the result files of a finished run (outputs/<gene>/<method>/<method>_<gene>.results.json,
+    # or outputs/<gene>/shards/<shard>/<method>/... for the shards of an alignment)
+    root = root or os.path.join(output_dir, "hyphy_store")
+    shutil.rmtree(root, ignore_errors=True)
+    store = HyphyStore(root)
+    for directory, _, files in os.walk(output_dir):
+        method = os.path.basename(directory)
+        for name in sorted(files):
+            if re.fullmatch(rf"{re.escape(method)}_.+\.results\.json", name) is None:
+                continue
+            gene = os.path.relpath(os.path.dirname(directory), output_dir)
+            # The shards are cut from the collapsed alignment of the gene, so they share its mapping
+            mappings = glob.glob(os.path.join(shard_of(os.path.dirname(directory))[0], "*.collapsed.tsv"))
+            try:
+                store.add(gene, method, os.path.join(directory, name), mappings[0] if len(mappings) > 0 else None,
+                          shard_offset(os.path.dirname(directory)))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping {name}: {e}")
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Site and branch store of the HyPhy results of a HighSPA output folder.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Stores the HyPhy results of an output folder.")
+    build_parser.add_argument("output", help="Output folder of the workflow.")
+    query_parser = subparsers.add_parser("sites", help="Lists the sites under selection in the genes of a store.")
+    query_parser.add_argument("store", help="Store folder (output_folder/hyphy_store).")
+    query_parser.add_argument("--alpha", help="P-value threshold of MEME, FEL and SLAC.", type=float, default=0.05)
+    query_parser.add_argument("--posterior", help="Posterior probability threshold of FUBAR.", type=float, default=0.9)
+    query_parser.add_argument("--methods", help="Comma separated methods (default: all).", type=str, default=None)
+    query_parser.add_argument("--min-methods", help="Minimum number of methods detecting the site.", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.command == "build":
+        print(build(args.output).root)
+    else:
+        methods = args.methods.split(",") if args.methods else None
+        store = HyphyStore(args.store)
+        print("gene\tsite\tmethods")
+        for (gene, site), found in store.significant_sites(args.alpha, args.posterior, methods, args.min_methods).items():
+            print(f"{gene}\t{site}\t{','.join(found)}")
@@ -0,0 +1,148 @@
+import os
+import re
+import csv
+import math
+import shlex
+import random
+import shutil
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from results import parse_codeml
+from runner import RUN_ID_ENV
+
+logger = logging.getLogger()
+
+# Models whose optimization depends the most on the initial omega/kappa (local optima)
+START_MODELS = ["M2", "M3", "M8"]
+# Starts whose lnL is this close to the best one are counted as reaching the same optimum
+LNL_TOLERANCE = 0.01
+# File of the model folder that makes the starts not yet executed exit without running CodeML,
+# named after the run so the marker left by an interrupted run does not skip the starts of a rerun
+STOP_MARKER = ".converged"
+STARTS_FILE = "multistart.tsv"
+INITIAL_RE = {name: re.compile(rf"^(\s*{name}\s*=\s*)\S+", re.M) for name in ("omega", "kappa")}
+
+
+def initial_values(seed, model, start):
+    # The first start keeps the values of the template; the others draw omega (log-uniform) and kappa,
+    # from the seed of the run, so a rerun (and the cache) sees the same ctl files
+    if start == 0:
+        return {}
+    rng = random.Random(f"{seed}:{model}:{start}")
+    return {"omega": round(math.exp(rng.uniform(math.log(0.05), math.log(10))), 4),
+            "kappa": round(rng.uniform(0.5, 8), 4)}
+
+
+def set_initial(ctl, initial):
+    for name, value in initial.items():
+        ctl = INITIAL_RE[name].sub(lambda m: f"{m.group(1)}{value}", ctl)
+    return ctl
+
+
+def start_dir(model_dir, start):
+    return os.path.join(model_dir, f"start{start}")
+
+
+def skip_command(marker, command):
+    # Checked when the task begins: the starts executed after the best lnL converged do nothing
+    return (f"if [ -e {shlex.quote(marker)} ]; then echo 'Skipped, the best lnL of the model already converged'; else\n"
+            f"{command}\nfi")
+
+
+def start_command(results_file, marker, command):
+    # Run by the task of a start, on its worker: the result of a previous run must not be taken
+    # as the result of a start skipped (or failed) by this one
+    return f"rm -f {shlex.quote(results_file)}\n" + (command if marker is None else skip_command(marker, command))
+
+
+class MultiStart:
+    # Runs each (gene, model) from `starts` initial values, one task per start in model/start<n>,
+    # and publishes the result of the start with the highest lnL in the model folder. With
+    # stop_after > 0, once that many starts reached the best lnL the remaining ones are skipped.
+    def __init__(self, starts, models=START_MODELS, seed=0, stop_after=0):
+        self.starts = starts
+        self.models = models
+        self.seed = seed
+        self.stop_after = stop_after
+        self.lock = threading.Lock()
+        self.futures = set()
+        # Reading the lnL of the starts and publishing the best one are done by a single thread,
+        # not by the callbacks of Parsl
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="multistart")
+
+    def add(self, submit, model_dir, prefix, model):
+        # submit(start, initial, marker) submits the task of one start and returns its future
+        results_name = f"{model}_{prefix}.results.txt"
+        marker = os.path.join(model_dir, f"{STOP_MARKER}.{os.environ.get(RUN_ID_ENV, os.getpid())}")
+        state = dict(model_dir=model_dir, prefix=prefix, model=model, results_name=results_name, marker=marker,
+                     initial=dict(), lnl=dict(), status=dict(), pending=self.starts, future=Future())
+        self.futures.add(state["future"])
+        state["future"].add_done_callback(self.futures.discard)
+        for start in range(self.starts):
+            state["initial"][start] = initial_values(self.seed, model, start)
+        for start in range(self.starts):
+            future = submit(start, state["initial"][start], marker if self.stop_after > 0 else None)
+            future.add_done_callback(lambda f, start=start: self.worker.submit(self._done, state, start, f))
+        return state["future"]
+
+    def _converged(self, state):
+        if self.stop_after <= 0 or len(state["lnl"]) == 0:
+            return False
+        best = max(state["lnl"].values())
+        return sum(1 for v in state["lnl"].values() if v >= best - LNL_TOLERANCE) >= self.stop_after
+
+    def _done(self, state, start, future):
+        path = os.path.join(start_dir(state["model_dir"], start), state["results_name"])
+        with self.lock:
+            if future.exception() is not None:
+                state["status"][start] = "failed"
+            elif not os.path.exists(path):
+                state["status"][start] = "skipped"
+            else:
+                try:
+                    state["lnl"][start] = parse_codeml(path)[0]["lnL"]
+                    state["status"][start] = "done"
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Start {start} of {state['model']} for {state['prefix']}: {e}")
+                    state["status"][start] = "failed"
+            state["pending"] -= 1
+            stop = state["pending"] > 0 and self._converged(state) and not os.path.exists(state["marker"])
+            last = state["pending"] == 0
+        if stop:
+            os.makedirs(state["model_dir"], exist_ok=True)
+            open(state["marker"], 'w').close()
+            logger.info(f"The best lnL of {state['model']} for {state['prefix']} was reached by {self.stop_after} starts, "
+                        f"skipping the remaining ones.")
+        if last:
+            try:
+                state["future"].set_result(self._reduce(state))
+            except (OSError, ValueError) as e:
+                state["future"].set_exception(e)
+
+    def _reduce(self, state):
+        model_dir, lnl = state["model_dir"], state["lnl"]
+        best = max(lnl, key=lnl.get) if len(lnl) > 0 else None
+        os.makedirs(model_dir, exist_ok=True)
+        with open(os.path.join(model_dir, STARTS_FILE), 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(["start", "omega", "kappa", "lnL", "status", "best"])
+            for start in range(self.starts):
+                initial = state["initial"][start]
+                writer.writerow([start, initial.get("omega", "template"), initial.get("kappa", "template"),
+                                 lnl.get(start, ""), state["status"].get(start, ""), int(start == best)])
+        if os.path.exists(state["marker"]):
+            os.remove(state["marker"])
+        if best is None:
+            raise ValueError(f"No start of {state['model']} finished for {state['prefix']}.")
+        # The best start is published as the result of the model (results file, rst, ...)
+        source = start_dir(model_dir, best)
+        for name in os.listdir(source):
+            if os.path.isfile(os.path.join(source, name)):
+                shutil.copyfile(os.path.join(source, name), os.path.join(model_dir, name))
+        logger.info(f"Best lnL of {state['model']} for {state['prefix']}: {lnl[best]} (start {best} of {self.starts}).")
+        return os.path.join(model_dir, state["results_name"])
+
+    def wait(self):
+        # The results are published by the worker, which may still be running when Parsl is done
+        wait(list(self.futures))
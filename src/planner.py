@@ -0,0 +1,73 @@
+import math
+import logging
+
+logger = logging.getLogger()
+
+# Estimated core-seconds of each stage. MAFFT grows with taxa^2 x sites, RAxML with
+# taxa x sites and each codon model with taxa x codons times a relative weight.
+MAFFT_COST = 2e-7
+RAXML_COST = 1e-4
+CODEML_COST = 5e-4
+HYPHY_COST = 2e-4
+CODEML_WEIGHTS = {"M0": 1, "M1": 2, "M2": 4, "M3": 4, "M7": 6, "M8": 10}
+HYPHY_WEIGHTS = {"slac": 1, "fel": 2, "fubar": 3, "ny": 4, "meme": 6, "absrel": 8}
+
+
+def estimate_costs(taxa, sites, codeml_models=[], hyphy_models=[]):
+    codons = math.ceil(sites / 3)
+    costs = {"mafft": MAFFT_COST * taxa * taxa * sites,
+             "raxml": RAXML_COST * taxa * sites}
+    for model in codeml_models:
+        costs[model] = CODEML_COST * CODEML_WEIGHTS[model] * taxa * codons
+    for model in hyphy_models:
+        costs[model] = HYPHY_COST * HYPHY_WEIGHTS[model] * taxa * codons
+    return costs
+
+
+def critical_path(costs):
+    # MAFFT -> RAxML -> the slowest of the models, which run in parallel
+    models = [cost for stage, cost in costs.items() if stage not in ("mafft", "raxml")]
+    return costs["mafft"] + costs["raxml"] + max(models, default=0)
+
+
+class Plan:
+    # Keeps only the aggregated costs, so the files can be planned as they are found.
+    # repeats gives the parallel executions of a stage (RAxML searches, CodeML starts):
+    # they multiply its core-hours but not the critical path.
+    def __init__(self, codeml_models=[], hyphy_models=[], repeats={}):
+        self.codeml_models = codeml_models
+        self.hyphy_models = hyphy_models
+        self.repeats = repeats
+        self.files = 0
+        self.stages = dict()
+        self.longest = 0
+
+    def add(self, path, taxa, sites):
+        costs = estimate_costs(taxa, sites, self.codeml_models, self.hyphy_models)
+        self.files += 1
+        self.longest = max(self.longest, critical_path(costs))
+        costs = {stage: cost * self.repeats.get(stage, 1) for stage, cost in costs.items()}
+        for stage, cost in costs.items():
+            self.stages[stage] = self.stages.get(stage, 0) + cost
+        return costs
+
+    def total(self):
+        return sum(self.stages.values())
+
+    def ideal_nodes(self, cpus_per_node):
+        # Beyond this number of nodes the makespan is bound by the slowest file
+        if self.longest == 0:
+            return 1
+        return max(1, math.ceil(self.total() / (self.longest * cpus_per_node)))
+
+    def report(self, cpus_per_node):
+        nodes = self.ideal_nodes(cpus_per_node)
+        makespan = max(self.longest, self.total() / (nodes * cpus_per_node))
+        lines = [f"Files: {self.files}",
+                 f"Estimated cost: {self.total() / 3600:.2f} core-hours",
+                 f"Longest file (critical path): {self.longest / 3600:.2f} hours"]
+        for stage, cost in sorted(self.stages.items(), key=lambda s: s[1], reverse=True):
+            lines.append(f"  {stage}: {cost / 3600:.2f} core-hours")
+        lines.append(f"Ideal number of nodes ({cpus_per_node} cores each): {nodes}")
+        lines.append(f"Estimated makespan with {nodes} node(s): {makespan / 3600:.2f} hours")
+        return "\n".join(lines)
@@ -0,0 +1,51 @@
+import os
+import math
+import logging
+
+logger = logging.getLogger()
+
+# Alignment cells (taxa x sites) that justify one extra thread for each tool.
+# Below these sizes the tools do not scale and one thread is used.
+CELLS_PER_THREAD = {
+    "mafft": 200_000,
+    "raxml": 100_000,
+    "hyphy": 50_000,
+    "codeml": None  # codeml is single-threaded
+}
+
+
+def node_cpus(slurm=False, threads=1):
+    # Number of cores shared by the tasks running in the same node
+    if slurm and os.getenv("SLURM_CPUS_ON_NODE"):
+        return int(os.getenv("SLURM_CPUS_ON_NODE"))
+    return threads
+
+
+def fasta_dimensions(path):
+    # Number of sequences and length of the longest one, reading the file only once
+    taxa = 0
+    sites = 0
+    length = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                taxa += 1
+                sites = max(sites, length)
+                length = 0
+            else:
+                length += len(line.strip())
+    return taxa, max(sites, length)
+
+
+class ThreadModel:
+    def __init__(self, node_cpus, max_threads=0):
+        self.node_cpus = node_cpus
+        # 0 means as many threads as the node has
+        self.max_threads = min(max_threads, node_cpus) if max_threads > 0 else node_cpus
+
+    def threads(self, tool, taxa, sites):
+        cells_per_thread = CELLS_PER_THREAD.get(tool)
+        if cells_per_thread is None:
+            return 1
+        wanted = math.ceil(taxa * sites / cells_per_thread)
+        return max(1, min(wanted, self.max_threads))
@@ -0,0 +1,256 @@
+import os
+import io
+import re
+import csv
+import logging
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import numpy as np
+from shards import shard_offset
+
+logger = logging.getLogger()
+
+# Nested pairs of site models compared by the likelihood ratio tests (null, alternative, degrees of freedom)
+LRT_PAIRS = [("M0", "M3", 4), ("M1", "M2", 2), ("M7", "M8", 2)]
+SUMMARY_COLUMNS = ["gene", "model", "lnL", "np", "kappa", "omega", "p_omega", "p0", "p", "q", "beb_sites"]
+BEB_COLUMNS = ["gene", "model", "site", "aa", "probability", "post_mean", "se"]
+LRT_COLUMNS = ["gene", "test", "lnL_null", "lnL_alt", "lrt", "df", "pvalue"]
+# Positively selected sites counted in the summary (BEB posterior probability of w > 1)
+BEB_THRESHOLD = 0.95
+
+LNL_RE = re.compile(r"lnL\(ntime:\s*(\d+)\s+np:\s*(\d+)\):\s+(-?[\d.]+)")
+KAPPA_RE = re.compile(r"kappa \(ts/tv\) =\s+([\d.]+)")
+OMEGA_RE = re.compile(r"omega \(dN/dS\) =\s+([\d.]+)")
+CLASSES_RE = re.compile(r"^p:\s+(.*)\n^w:\s+(.*)$", re.M)
+P0_RE = re.compile(r"p0 =\s*([\d.]+)")
+BETA_RE = re.compile(r"\bp =\s*([\d.]+)\s+q =\s*([\d.]+)")
+BEB_SITE_RE = re.compile(r"^\s+(\d+)\s+(\S)\s+([\d.]+)\**\s+([\d.]+)\s+\+-\s+([\d.]+)")
+
+
+def parse_codeml(path):
+    # Extracts the estimates of a CodeML result file (outfile of the ctl) in a single pass
+    with open(path, 'r') as f:
+        text = f.read()
+    lnl = LNL_RE.search(text)
+    if lnl is None:
+        raise ValueError(f"{path} has no lnL, CodeML did not finish.")
+    row = {"lnL": float(lnl.group(3)), "np": int(lnl.group(2)),
+           "kappa": np.nan, "omega": np.nan, "p_omega": np.nan, "p0": np.nan, "p": np.nan, "q": np.nan}
+    kappa = KAPPA_RE.search(text)
+    if kappa is not None:
+        row["kappa"] = float(kappa.group(1))
+    omega = OMEGA_RE.search(text)
+    if omega is not None:
+        row["omega"] = float(omega.group(1))
+        row["p_omega"] = 1.0
+    classes = CLASSES_RE.search(text)
+    if classes is not None:
+        # Site classes: the summary keeps the class with the largest w and its proportion
+        p = [float(v) for v in classes.group(1).split()]
+        w = [float(v) for v in classes.group(2).split()]
+        row["omega"], row["p_omega"] = max(zip(w, p))
+    p0 = P0_RE.search(text)
+    if p0 is not None:
+        row["p0"] = float(p0.group(1))
+    beta = BETA_RE.search(text)
+    if beta is not None:
+        row["p"], row["q"] = float(beta.group(1)), float(beta.group(2))
+    beb = []
+    start = text.find("Bayes Empirical Bayes (BEB)")
+    if start >= 0:
+        for line in text[start:].splitlines()[1:]:
+            if line.startswith("The grid"):
+                break
+            site = BEB_SITE_RE.match(line)
+            if site is not None:
+                beb.append({"site": int(site.group(1)), "aa": site.group(2), "probability": float(site.group(3)),
+                            "post_mean": float(site.group(4)), "se": float(site.group(5))})
+    row["beb_sites"] = sum(1 for s in beb if s["probability"] > BEB_THRESHOLD)
+    return row, beb
+
+
+def chi2_sf(x, df):
+    # Survival function of the chi-square distribution for even degrees of freedom, closed form:
+    # exp(-x/2) * sum_{i<df/2} (x/2)^i / i!, evaluated over the whole array at once
+    half = np.asarray(x, dtype=float) / 2
+    term = np.ones_like(half)
+    total = np.zeros_like(half)
+    for i in range(df // 2):
+        total += term
+        term = term * half / (i + 1)
+    return np.exp(-half) * total
+
+
+def load_table(path):
+    # Columnar view of a tsv table: a numpy array per column. Repeated rows of a
+    # (gene, model) pair (reruns) keep the last one.
+    rows = dict()
+    if os.path.exists(path):
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                rows[(row["gene"], row["model"])] = row
+    rows = list(rows.values())
+    columns = {"gene": np.array([r["gene"] for r in rows], dtype=str),
+               "model": np.array([r["model"] for r in rows], dtype=str)}
+    columns["lnL"] = np.array([float(r["lnL"]) for r in rows], dtype=float)
+    return columns
+
+
+def likelihood_ratio_tests(columns):
+    # All the genes of a test are computed in one vectorized pass
+    tests = []
+    for null, alt, df in LRT_PAIRS:
+        null_rows = columns["model"] == null
+        alt_rows = columns["model"] == alt
+        genes, i_null, i_alt = np.intersect1d(columns["gene"][null_rows], columns["gene"][alt_rows], return_indices=True)
+        if len(genes) == 0:
+            continue
+        lnl_null = columns["lnL"][null_rows][i_null]
+        lnl_alt = columns["lnL"][alt_rows][i_alt]
+        lrt = np.maximum(2 * (lnl_alt - lnl_null), 0)
+        tests.append((f"{null}vs{alt}", genes, lnl_null, lnl_alt, lrt, df, chi2_sf(lrt, df)))
+    return tests
+
+
+class CodemlResults:
+    # Aggregates the CodeML results of the run into tsv tables in the output folder. Each
+    # result file is parsed as soon as its task finishes, so only the LRTs remain at the end.
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.summary_file = os.path.join(output_dir, "codeml_summary.tsv")
+        self.beb_file = os.path.join(output_dir, "codeml_beb.tsv")
+        self.lrt_file = os.path.join(output_dir, "codeml_lrt.tsv")
+        self.lock = threading.Lock()
+        self.pending = set()
+        # Size of each table before the first row of this run: the rows after it replace
+        # the rows of the same (gene, model) written by previous runs
+        self.start = dict()
+        # The result files are parsed by a single thread, not by the callbacks of Parsl
+        self.collector = ThreadPoolExecutor(max_workers=1, thread_name_prefix="codeml-results")
+
+    def _append(self, path, columns, rows):
+        new = not os.path.exists(path)
+        self.start.setdefault(path, 0 if new else os.path.getsize(path))
+        with open(path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, delimiter='\t')
+            if new:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    def add(self, gene, model, result_file, offset=0):
+        # offset: codons of the alignment before the shard of the result, so the BEB sites of
+        # the shards of a gene are numbered in the coordinates of its whole alignment
+        row, beb = parse_codeml(result_file)
+        with self.lock:
+            self._append(self.summary_file, SUMMARY_COLUMNS, [dict(row, gene=gene, model=model)])
+            if len(beb) > 0:
+                self._append(self.beb_file, BEB_COLUMNS, [dict(site, gene=gene, model=model, site=site["site"] + offset)
+                                                          for site in beb])
+
+    def _compact(self, path, columns, key, added=None):
+        # Rewrites a table with the last row of each key. The rows of previous runs of the
+        # (gene, model) pairs added by this run are dropped (e.g. BEB sites that are gone).
+        if not os.path.exists(path):
+            return set() if added is None else added
+        start = self.start.get(path, os.path.getsize(path))
+        with open(path, 'rb') as f:
+            data = f.read()
+        # A table created by this run starts with its header
+        new = io.StringIO(data[start:].decode(), newline='')
+        new = list(csv.DictReader(new, delimiter='\t') if start == 0 else csv.DictReader(new, fieldnames=columns, delimiter='\t'))
+        if added is None:
+            added = {(row["gene"], row["model"]) for row in new}
+        rows = dict()
+        for row in csv.DictReader(io.StringIO(data[:start].decode(), newline=''), delimiter='\t'):
+            if (row["gene"], row["model"]) not in added:
+                rows[tuple(row[c] for c in key)] = row
+        for row in new:
+            rows[tuple(row[c] for c in key)] = row
+        with open(path + ".tmp", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(rows.values())
+        os.replace(path + ".tmp", path)
+        self.start[path] = os.path.getsize(path)
+        return added
+
+    def watch(self, future, gene, model, result_file, offset=0):
+        # Returns a future resolved once the result is in the tables (or could not be read)
+        stored = Future()
+        with self.lock:
+            self.pending.add(stored)
+        stored.add_done_callback(self._settled)
+
+        def parse():
+            try:
+                self.add(gene, model, result_file, offset)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read the CodeML result {result_file}: {e}")
+            finally:
+                stored.set_result(None)
+
+        def done(f):
+            # Runs in the completion thread of Parsl: only hands the file to the collector
+            if f.exception() is None:
+                self.collector.submit(parse)
+            else:
+                stored.set_result(None)
+        future.add_done_callback(done)
+        return stored
+
+    def _settled(self, stored):
+        # Runs in the collector thread (or in Parsl's, for failed tasks) while wait may be reading the set
+        with self.lock:
+            self.pending.discard(stored)
+
+    def wait(self):
+        # The last result files may still be queued in the collector when Parsl is done
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def summarize(self):
+        with self.lock:
+            # A pair of this run replaces its BEB sites even when it has none now
+            added = self._compact(self.summary_file, SUMMARY_COLUMNS, ("gene", "model"))
+            self._compact(self.beb_file, BEB_COLUMNS, ("gene", "model", "site"), added)
+            tests = likelihood_ratio_tests(load_table(self.summary_file))
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.lrt_file, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(LRT_COLUMNS)
+            for test, genes, lnl_null, lnl_alt, lrt, df, pvalue in tests:
+                for n, gene in enumerate(genes):
+                    writer.writerow([gene, test, lnl_null[n], lnl_alt[n], f"{lrt[n]:.6f}", df, f"{pvalue[n]:.6g}"])
+        for test, genes, lnl_null, lnl_alt, lrt, df, pvalue in tests:
+            logger.info(f"{test}: {int((pvalue < 0.05).sum())} of {len(genes)} genes with p < 0.05.")
+        return self.lrt_file
+
+
+def collect(output_dir):
+    # Rebuilds the tables from the result files of a finished run (outputs/<gene>/<model>/<model>_<gene>.results.txt,
+    # or outputs/<gene>/shards/<shard>/<model>/... for the shards of an alignment)
+    results = CodemlResults(output_dir)
+    for path in (results.summary_file, results.beb_file):
+        if os.path.exists(path):
+            os.remove(path)
+    for directory, _, files in os.walk(output_dir):
+        model = os.path.basename(directory)
+        for name in files:
+            if re.fullmatch(rf"{re.escape(model)}_.+\.results\.txt", name) is None:
+                continue
+            gene = os.path.relpath(os.path.dirname(directory), output_dir)
+            try:
+                results.add(gene, model, os.path.join(directory, name), shard_offset(os.path.dirname(directory)))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping {name}: {e}")
+    return results.summarize()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregates the CodeML results of a HighSPA output folder and computes the LRTs.")
+    parser.add_argument("output", help="Output folder of the workflow.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    print(collect(args.output))
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import shlex
+import argparse
+import tempfile
+import subprocess
+
+# Placeholder replaced by the number of threads granted to the task
+THREADS_PLACEHOLDER = "%=THREADS%"
+# Environment variable with the ID of the run, which keys the core ledger of each node
+RUN_ID_ENV = "HIGHSPA_RUN_ID"
+
+
+def ledger_dir():
+    # Node-local directory shared by the workers of one run on the node: the run ID exported by
+    # the workflow to its workers, or the SLURM job of the worker when it runs outside of it
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    run = os.environ.get(RUN_ID_ENV) or os.environ.get("SLURM_JOB_ID") or "local"
+    return os.path.join(base, f"highspa-cores-{os.getuid()}-{run}")
+
+
+class CoreLedger:
+    # Each core of the node is a lock file; a task holds the locks of the cores it uses.
+    # Locks are released by the kernel if the task dies, so the ledger cannot leak cores.
+    def __init__(self, total, directory=None):
+        self.total = total
+        self.directory = directory or ledger_dir()
+        os.makedirs(self.directory, exist_ok=True)
+        self.waiter = os.path.join(self.directory, f"wait.{os.getpid()}")
+        self.held = []
+
+    def _try_lock(self, core):
+        fd = os.open(os.path.join(self.directory, f"core.{core}"), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+    def waiting(self):
+        # Other tasks of this node that are waiting for cores; the files of the tasks that
+        # died while waiting are removed, so their PIDs cannot be counted once reused
+        count = 0
+        for name in os.listdir(self.directory):
+            if name.startswith("wait.") and name != os.path.basename(self.waiter):
+                try:
+                    os.kill(int(name.split(".", 1)[1]), 0)
+                    count += 1
+                except ProcessLookupError:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+                except (OSError, ValueError):
+                    pass
+        return count
+
+    def release(self, fds=None):
+        for fd in (self.held if fds is None else fds):
+            os.close(fd)
+        if fds is None:
+            self.held = []
+
+    def acquire(self, wanted, minimum=1):
+        minimum = min(minimum, self.total)
+        delay = 0.05
+        while True:
+            cores = list(range(self.total))
+            random.shuffle(cores)
+            for core in cores:
+                fd = self._try_lock(core)
+                if fd is not None:
+                    self.held.append(fd)
+                    if len(self.held) == wanted:
+                        break
+            # Free cores are left to the tasks already waiting, so a large task
+            # only grows when the node is not busy
+            granted = max(minimum, min(wanted, len(self.held) - self.waiting()))
+            if len(self.held) >= granted:
+                self.release(self.held[granted:])
+                self.held = self.held[:granted]
+                if os.path.exists(self.waiter):
+                    os.remove(self.waiter)
+                return granted
+            self.release()
+            open(self.waiter, 'w').close()
+            time.sleep(delay * (1 + random.random()))
+            delay = min(delay * 2, 0.5)
+
+
+def record(trace, entry):
+    # One json line per task in the file of its node (the trace is a folder), written by a single
+    # append so the lines of the tasks of the node stay whole; the nodes never share a file,
+    # since appends from several clients of NFS or Lustre can overwrite each other
+    os.makedirs(trace, exist_ok=True)
+    fd = os.open(os.path.join(trace, f"{entry['host']}.jsonl"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry, separators=(",", ":")) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def io_counters(pid):
+    # Bytes passed to read and write by a process that exited but was not reaped yet, including the
+    # children it reaped (the tool); unlike the blocks of rusage, they also count network file systems
+    try:
+        with open(f"/proc/{pid}/io", 'r') as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run(command, threads=1, min_threads=1, node_cpus=None, trace=None, task={}):
+    ledger = None
+    submitted = time.time()
+    if node_cpus:
+        ledger = CoreLedger(node_cpus)
+        threads = ledger.acquire(threads, min_threads)
+    try:
+        command = command.replace(THREADS_PLACEHOLDER, str(threads))
+        start = time.time()
+        child = subprocess.Popen(command, shell=True, executable="/bin/bash")
+        io = None
+        if trace and hasattr(os, "WNOWAIT"):
+            # Waits without reaping, so the I/O of the shell and of the tool can still be read
+            os.waitid(os.P_PID, child.pid, os.WEXITED | os.WNOWAIT)
+            io = io_counters(child.pid)
+        # wait4 returns the resource usage of the tool (and of the processes it waited for)
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = os.waitstatus_to_exitcode(status)
+        end = time.time()
+    finally:
+        if ledger is not None:
+            ledger.release()
+    if trace:
+        record(trace, dict(task, host=os.uname().nodename, node_cpus=node_cpus, threads=threads,
+                           wait=round(start - submitted, 3), start=round(start, 3), end=round(end, 3),
+                           user=round(usage.ru_utime, 3), sys=round(usage.ru_stime, 3), maxrss_kb=usage.ru_maxrss,
+                           read_bytes=io[0] if io else usage.ru_inblock * 512, write_bytes=io[1] if io else usage.ru_oublock * 512,
+                           exit=child.returncode))
+    return child.returncode
+
+
+def runner_command(command, threads=1, min_threads=1, node_cpus=None, trace=None, task={}):
+    # Wraps a command of the bash apps so it only starts when its cores are free in the node
+    # and, with a trace file, records the resources used by the tool
+    if not node_cpus and not trace:
+        return command.replace(THREADS_PLACEHOLDER, str(threads))
+    cmd = f"{sys.executable} {os.path.abspath(__file__)} --threads {threads} --min-threads {min_threads}"
+    if node_cpus:
+        cmd += f" --node-cpus {node_cpus}"
+    if trace:
+        cmd += f" --trace {shlex.quote(trace)}"
+        for key, value in task.items():
+            cmd += f" --{key} {shlex.quote(str(value))}"
+    return f"{cmd} -- {shlex.quote(command)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a HighSPA task inside the core budget of the node.")
+    parser.add_argument("--threads", help="Maximum number of threads of the task.", type=int, default=1)
+    parser.add_argument("--min-threads", help="Minimum number of threads of the task.", type=int, default=1)
+    parser.add_argument("--node-cpus", help="Cores shared by the tasks of the node.", type=int, default=None)
+    parser.add_argument("--trace", help="Folder of the trace, whose JSON lines file of this node receives the resources used by the task.", default=None)
+    parser.add_argument("--gene", help="Output folder of the gene, recorded in the trace.", default="")
+    parser.add_argument("--tool", help="Tool of the task, recorded in the trace.", default="")
+    parser.add_argument("--model", help="Model of the task, recorded in the trace.", default="")
+    parser.add_argument("--start", help="Index of the CodeML start or of the RAxML search of a fanned-out task, recorded in the trace.", type=int, default=None)
+    parser.add_argument("--shard", help="Partition of the alignment of the task (shards/<name>), recorded in the trace.", default=None)
+    parser.add_argument("command", help="Command, %%=THREADS%% is replaced by the threads granted.")
+    args = parser.parse_args()
+    task = dict(gene=args.gene, tool=args.tool, model=args.model)
+    if args.start is not None:
+        task["start"] = args.start
+    if args.shard is not None:
+        task["shard"] = args.shard
+    sys.exit(run(args.command, args.threads, args.min_threads, args.node_cpus, args.trace, task))
@@ -0,0 +1,74 @@
+import os
+import sys
+import glob
+import shlex
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+
+# Placeholder replaced by the scratch directory of the task
+SCRATCH_PLACEHOLDER = "%=SCRATCH%"
+# Outputs copied back to the shared filesystem when no allow-list is given
+DEFAULT_KEEP = ["*.results.*", "rst"]
+
+
+def scratch_base(base):
+    # The base may refer to variables of the worker node, e.g. $TMPDIR
+    base = os.path.expandvars(base)
+    if "$" in base or not os.path.isdir(base):
+        return tempfile.gettempdir()
+    return base
+
+
+def run_in_scratch(command, base, dest, stage=[], keep=DEFAULT_KEEP):
+    workdir = tempfile.mkdtemp(prefix="highspa-", dir=scratch_base(base))
+    child = None
+
+    def terminate(signum, frame):
+        # Parsl (or SLURM) killed the task: stop the tool and clean the scratch anyway
+        if child is not None and child.poll() is None:
+            child.terminate()
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    try:
+        for path in stage:
+            shutil.copyfile(path, os.path.join(workdir, os.path.basename(path)))
+        child = subprocess.Popen(command.replace(SCRATCH_PLACEHOLDER, workdir), shell=True,
+                                 executable="/bin/bash", cwd=workdir)
+        returncode = child.wait()
+        # Only the allow-listed outputs go back to the shared filesystem, in one pass at the end
+        staged = set(os.path.basename(p) for p in stage)
+        kept = sorted(set(name for pattern in keep for name in glob.glob(pattern, root_dir=workdir)
+                          if name not in staged and os.path.isfile(os.path.join(workdir, name))))
+        if len(kept) > 0:
+            os.makedirs(dest, exist_ok=True)
+            for name in kept:
+                shutil.copyfile(os.path.join(workdir, name), os.path.join(dest, name))
+        return returncode
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def scratch_command(command, base, dest, stage=[], keep=None):
+    # Wraps a command of the bash apps to be executed in a node-local scratch directory
+    cmd = f"{sys.executable} {os.path.abspath(__file__)} --base {shlex.quote(base)} --dest {shlex.quote(str(dest))}"
+    for path in stage:
+        cmd += f" --stage {shlex.quote(str(path))}"
+    for pattern in (keep or DEFAULT_KEEP):
+        cmd += f" --keep {shlex.quote(pattern)}"
+    return f"{cmd} -- {shlex.quote(command)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a HighSPA task in a node-local scratch directory.")
+    parser.add_argument("--base", help="Node-local folder where the scratch directory is created.", default="$TMPDIR")
+    parser.add_argument("--dest", help="Folder that receives the outputs kept.", required=True)
+    parser.add_argument("--stage", help="Input file copied to the scratch directory.", action="append", default=[])
+    parser.add_argument("--keep", help="Glob pattern of the outputs copied back.", action="append", default=[])
+    parser.add_argument("command", help="Command, %%=SCRATCH%% is replaced by the scratch directory.")
+    args = parser.parse_args()
+    sys.exit(run_in_scratch(args.command, args.base, args.dest, args.stage, args.keep or DEFAULT_KEEP))
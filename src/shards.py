@@ -0,0 +1,125 @@
+import os
+import csv
+import sys
+import shlex
+import argparse
+from collapse import read_alignment
+from format_phylip import post_process_phylip
+
+SHARDS_FILE = "shards.tsv"
+SHARD_COLUMNS = ["shard", "start", "end", "first_codon"]
+
+
+def read_coordinates(path):
+    # Partitions of the alignment (name, first and last column, 1-based nucleotides), one per line,
+    # e.g. "E<tab>937<tab>2421". The columns must keep the reading frame of the codons.
+    shards = []
+    with open(path, 'r') as f:
+        for n, line in enumerate(f, 1):
+            fields = line.split()
+            if len(fields) == 0 or line.startswith("#"):
+                continue
+            if len(fields) < 3 or not fields[1].isdigit() or not fields[2].isdigit():
+                # A header (e.g. "name start end") is only accepted before the first partition
+                if len(shards) == 0 and len(fields) >= 3 and not fields[1].isdigit():
+                    continue
+                raise ValueError(f"Line {n} of {path}: expected a name, a start and an end column, got '{line.strip()}'.")
+            name, start, end = fields[0], int(fields[1]), int(fields[2])
+            if (start - 1) % 3 != 0 or (end - start + 1) % 3 != 0 or end < start:
+                raise ValueError(f"Line {n} of {path}: {name} ({start}-{end}) does not start at a codon "
+                                 f"or does not have a whole number of codons.")
+            shards.append((name, start, end))
+    if len(shards) == 0:
+        raise ValueError(f"{path} has no coordinates.")
+    return shards
+
+
+def windows(sites, codons):
+    # Windows of `codons` codons over an alignment of about `sites` columns; the last one goes
+    # up to the end of the alignment, which may be longer than the sequences because of the gaps
+    count = max(1, (sites // 3) // codons)
+    shards = [(f"window{n + 1}", n * codons * 3 + 1, (n + 1) * codons * 3) for n in range(count)]
+    name, start, _ = shards[-1]
+    shards[-1] = (name, start, None)
+    return shards
+
+
+def shard_dir(dir_outputs, name):
+    return os.path.join(dir_outputs, "shards", name)
+
+
+def first_codon(start):
+    # Codons of the alignment before the shard: added to the sites of its results
+    return (start - 1) // 3
+
+
+def write_shards(alignment, dir_outputs, prefix, shards, formatted=False):
+    # Writes the columns of each shard as a sequential phylip file (and the CodeML version of it)
+    names, sites, _, sequences = read_alignment(alignment, keep_sequences=True)
+    rows = []
+    for name, start, end in shards:
+        end = sites if end is None else min(end, sites)
+        if start > end:
+            raise ValueError(f"Shard {name} starts at column {start}, but the alignment has {sites} columns.")
+        directory = shard_dir(dir_outputs, name)
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, f"{prefix}.mafft")
+        with open(output, 'w') as f:
+            f.write(f"{len(names)} {end - start + 1}\n")
+            for taxon, sequence in zip(names, sequences):
+                f.write(f"{taxon:<10}  {sequence[start - 1:end]}\n")
+        if formatted:
+            post_process_phylip(output, os.path.join(directory, f"{prefix}_formatted.phylip"))
+        rows.append([name, start, end, first_codon(start)])
+    with open(os.path.join(dir_outputs, SHARDS_FILE), 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(SHARD_COLUMNS)
+        writer.writerows(rows)
+
+
+def shard_of(directory):
+    # (folder of the gene, shard) of a folder gene/shards/<name>; (folder, None) outside the shards
+    parent, name = os.path.split(os.path.normpath(directory))
+    if os.path.basename(parent) == "shards":
+        return os.path.dirname(parent), name
+    return directory, None
+
+
+def shard_offset(directory):
+    # Codons before the shard of a folder gene/shards/<name>, from the shards.tsv of the gene
+    gene_dir, name = shard_of(directory)
+    if name is None:
+        return 0
+    try:
+        with open(os.path.join(gene_dir, SHARDS_FILE), 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                if row["shard"] == name:
+                    return int(row["first_codon"])
+    except OSError:
+        pass
+    return 0
+
+
+def shard_command(alignment, dir_outputs, prefix, shards, formatted=False):
+    # Command appended to the MAFFT task, after the alignment (and its collapsing) is written
+    cmd = f"{sys.executable} {os.path.abspath(__file__)} {shlex.quote(str(alignment))} {shlex.quote(str(dir_outputs))} {shlex.quote(prefix)}"
+    if formatted:
+        cmd += " --formatted"
+    for name, start, end in shards:
+        cmd += f" --shard {shlex.quote(name)}:{start}:{end or ''}"
+    return cmd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Splits an alignment into codon-aligned partitions.")
+    parser.add_argument("alignment", help="Phylip alignment (MAFFT --phylipout).")
+    parser.add_argument("dir_outputs", help="Output folder of the file; the shards go to dir_outputs/shards/<name>.")
+    parser.add_argument("prefix", help="Prefix of the file.")
+    parser.add_argument("--shard", help="name:start:end of a shard (1-based columns, an empty end goes up to the last column).", action="append", default=[])
+    parser.add_argument("--formatted", help="Also writes the alignment of each shard formatted for CodeML.", action="store_true")
+    args = parser.parse_args()
+    shards = []
+    for spec in args.shard:
+        name, start, end = spec.rsplit(":", 2)
+        shards.append((name, int(start), int(end) if end else None))
+    write_shards(args.alignment, args.dir_outputs, args.prefix, shards, args.formatted)
@@ -0,0 +1,106 @@
+import os
+import heapq
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger()
+
+
+def scan_inputs(root):
+    # Walks the input folder with os.scandir, yielding the files as they are found
+    # (the file type comes from the directory entry, without a stat per file)
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                subdirs = []
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=True):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=True):
+                        yield entry.path
+        except OSError as e:
+            logger.warning(f"Skipping {directory}: {e}")
+            continue
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def read_manifest(manifest, root):
+    # One file per line, relative to the input folder or absolute, optionally followed
+    # by the number of sequences and sites (tab separated) to skip reading the file
+    with open(manifest, 'r') as f:
+        for n, line in enumerate(f, 1):
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields[0]) == 0 or fields[0].startswith('#'):
+                continue
+            path = os.path.join(root, fields[0])
+            if not os.path.isfile(path):
+                raise ValueError(f"Line {n} of {manifest}: {path} is not a file.")
+            if len(fields) >= 3:
+                try:
+                    dimensions = (int(fields[1]), int(fields[2]))
+                except ValueError:
+                    raise ValueError(f"Line {n} of {manifest}: the number of sequences and sites must be integers, "
+                                     f"got '{fields[1]}' and '{fields[2]}'.") from None
+                yield path, dimensions
+            else:
+                yield path, None
+
+
+def order_by_cost(entries, cost, window=0):
+    # Longest job first inside a lookahead window: the most expensive of the next
+    # `window` entries is yielded first. window=0 sorts all the entries.
+    if window <= 0:
+        yield from sorted(entries, key=cost, reverse=True)
+        return
+    heap = []
+    for n, entry in enumerate(entries):
+        heapq.heappush(heap, (-cost(entry), n, entry))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def settled(futures):
+    # Future resolved when all the futures finish, successfully or not, so the tasks that
+    # receive it in inputs run even if some of them failed
+    result = Future()
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            last = pending[0] == 0
+        if last:
+            result.set_result(None)
+    if len(futures) == 0:
+        result.set_result(None)
+    for f in futures:
+        f.add_done_callback(done)
+    return result
+
+
+class InflightLimiter:
+    # Bounds the number of files with tasks in the DataFlowKernel. A file leaves
+    # the window when all of its last tasks finish (successfully or not).
+    def __init__(self, max_inflight=0):
+        self.max_inflight = max_inflight
+        self.slots = threading.BoundedSemaphore(max_inflight) if max_inflight > 0 else None
+
+    def acquire(self, on_wait=None):
+        if self.slots is None:
+            return
+        # on_wait runs before blocking, e.g. to submit the tasks held by a partial bundle
+        if not self.slots.acquire(blocking=False):
+            if on_wait is not None:
+                on_wait()
+            self.slots.acquire()
+
+    def track(self, futures):
+        if self.slots is None:
+            return
+        settled(futures).add_done_callback(lambda _: self.slots.release())
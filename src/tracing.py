@@ -0,0 +1,145 @@
+import os
+import json
+import logging
+import argparse
+
+logger = logging.getLogger()
+
+# Stages that precede the models of a gene in the DAG (MAFFT -> RAxML -> each model)
+PREDECESSOR = {"mafft": None, "raxml": "mafft"}
+
+
+def trace_files(path):
+    # The trace of a run is a folder with a JSON lines file per node (or a single file)
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl"))
+    return [path] if os.path.isfile(path) else []
+
+
+def read_trace(path):
+    # Keeps the last record of each (gene, stage), e.g. the retry of a failed task; the starts
+    # of a multi-start CodeML model and the shards of an alignment are kept apart
+    lines = []
+    for name in trace_files(path):
+        with open(name, 'r') as f:
+            for line in f:
+                try:
+                    lines.append(json.loads(line))
+                except ValueError:
+                    continue
+    records = dict()
+    for r in sorted(lines, key=lambda r: r["end"]):
+        r["stage"] = r.get("model") or r.get("tool")
+        r["wall"] = r["end"] - r["start"]
+        r["cpu"] = r["user"] + r["sys"]
+        records[(r["gene"], r["stage"], r.get("start"), r.get("shard"))] = r
+    return list(records.values())
+
+
+def last_of_stage(records):
+    # Record of each (gene, stage) that ended last: with several RAxML searches (or CodeML
+    # starts) of a gene, it is the one that released the next stage
+    last = dict()
+    for r in records:
+        key = (r["gene"], r["stage"])
+        if key not in last or r["end"] > last[key]["end"]:
+            last[key] = r
+    return last
+
+
+def stage_table(records):
+    stages = dict()
+    for r in records:
+        s = stages.setdefault(r["stage"], dict(tasks=0, wall=0, cpu=0, allocated=0, wait=0, maxrss_kb=0,
+                                               read_bytes=0, write_bytes=0, failed=0))
+        s["tasks"] += 1
+        s["wall"] += r["wall"]
+        s["cpu"] += r["cpu"]
+        s["allocated"] += r["threads"] * r["wall"]
+        s["wait"] += r["wait"]
+        s["maxrss_kb"] = max(s["maxrss_kb"], r["maxrss_kb"])
+        s["read_bytes"] += r["read_bytes"]
+        s["write_bytes"] += r["write_bytes"]
+        s["failed"] += r["exit"] != 0
+    return stages
+
+
+def idle_cores(records):
+    # Core-seconds of each node not given to any tool between its first start and its last end
+    hosts = dict()
+    for r in records:
+        h = hosts.setdefault(r["host"], dict(start=r["start"], end=r["end"], allocated=0, cpus=r.get("node_cpus")))
+        h["start"] = min(h["start"], r["start"])
+        h["end"] = max(h["end"], r["end"])
+        h["allocated"] += r["threads"] * r["wall"]
+    return {host: (h["cpus"] * (h["end"] - h["start"]) - h["allocated"] if h["cpus"] else None)
+            for host, h in hosts.items()}
+
+
+def critical_path(records):
+    # Walks back from the last task to finish through the task it depended on. The gap
+    # between a task and its predecessor is the time it spent queued or waiting for cores.
+    by_stage = last_of_stage(records)
+    path = []
+    task = max(records, key=lambda r: r["end"])
+    while task is not None:
+        previous = PREDECESSOR.get(task["stage"], "raxml")
+        parent = by_stage.get((task["gene"], previous)) if previous is not None else None
+        path.append((task, task["start"] - (parent["end"] if parent is not None else task["start"] - task["wait"])))
+        task = parent
+    return list(reversed(path))
+
+
+def slowest_models(records):
+    # How often each model is the last one of its gene, i.e. the one that closes the gene
+    genes = dict()
+    for r in records:
+        if r["stage"] not in PREDECESSOR:
+            if r["gene"] not in genes or r["wall"] > genes[r["gene"]]["wall"]:
+                genes[r["gene"]] = r
+    counts = dict()
+    for r in genes.values():
+        counts[r["stage"]] = counts.get(r["stage"], 0) + 1
+    return counts
+
+
+def report(records):
+    start = min(r["start"] - r["wait"] for r in records)
+    end = max(r["end"] for r in records)
+    lines = [f"Tasks: {len(records)}", f"Makespan: {(end - start) / 3600:.2f} hours"]
+    lines.append("Stage      tasks  core-hours  cpu-hours  utilization  mean wait (s)  max RSS (MB)  read (GB)  written (GB)  failed")
+    for stage, s in sorted(stage_table(records).items(), key=lambda s: s[1]["allocated"], reverse=True):
+        utilization = s["cpu"] / s["allocated"] if s["allocated"] > 0 else 0
+        lines.append(f"{stage:<10} {s['tasks']:>5}  {s['allocated'] / 3600:>10.2f}  {s['cpu'] / 3600:>9.2f}  {utilization:>10.0%}"
+                     f"  {s['wait'] / s['tasks']:>13.1f}  {s['maxrss_kb'] / 1024:>12.0f}  {s['read_bytes'] / 2**30:>9.2f}"
+                     f"  {s['write_bytes'] / 2**30:>12.2f}  {s['failed']:>6}")
+    idle = idle_cores(records)
+    for host, seconds in sorted(idle.items()):
+        lines.append(f"Idle cores on {host}: " + (f"{seconds / 3600:.2f} core-hours" if seconds is not None else "unknown (no --node-cpus)"))
+    path = critical_path(records)
+    lines.append(f"Critical path ({path[-1][0]['gene']}):")
+    on_path = dict()
+    for task, gap in path:
+        lines.append(f"  {task['stage']:<10} queued {gap:>9.1f} s  ran {task['wall']:>9.1f} s  with {task['threads']} thread(s)")
+        on_path[task["stage"]] = task["wall"]
+        on_path["queued"] = on_path.get("queued", 0) + gap
+    total = sum(on_path.values())
+    if total > 0:
+        stage, seconds = max(on_path.items(), key=lambda s: s[1])
+        lines.append(f"Limiting the critical path: {stage} ({seconds / total:.0%} of it)")
+    counts = slowest_models(records)
+    if len(counts) > 0:
+        genes = sum(counts.values())
+        lines.append("Slowest model of each gene: " + ", ".join(
+            f"{stage} {count / genes:.0%}" for stage, count in sorted(counts.items(), key=lambda c: c[1], reverse=True)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarizes the resources trace of a HighSPA run.")
+    parser.add_argument("trace", help="Trace folder of the run (output_folder/trace-<date>).")
+    args = parser.parse_args()
+    records = read_trace(args.trace)
+    if len(records) == 0:
+        parser.error(f"{args.trace} has no tasks.")
+    print(report(records))
@@ -0,0 +1,66 @@
+import os
+import re
+import csv
+import sys
+import shlex
+import shutil
+import argparse
+
+# Log-likelihood of the best tree of a RAxML search, written at the end of RAxML_info
+SCORE_RE = re.compile(r"Final GAMMA-based Score of best tree\s+(-?[\d.]+(?:[eE][-+]?\d+)?)")
+SEARCHES_FILE = "raxml_searches.tsv"
+
+
+def search_dir(dir_outputs, seed):
+    # Each seeded search runs in its own folder, kept after the best tree is chosen
+    return os.path.join(dir_outputs, "raxml_searches", f"seed{seed}")
+
+
+def read_score(info_file):
+    with open(info_file, 'r') as f:
+        found = SCORE_RE.findall(f.read())
+    if len(found) == 0:
+        raise ValueError(f"{info_file} has no final GAMMA-based score, RAxML did not finish.")
+    return float(found[-1])
+
+
+def publish_best(searches, output_dir, prefix):
+    # Copies the RAxML files of the search with the highest likelihood to the gene folder
+    scores = dict()
+    for directory in searches:
+        try:
+            scores[directory] = read_score(os.path.join(directory, f"RAxML_info.{prefix}_output.tree"))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring the search of {directory}: {e}", file=sys.stderr)
+    if len(scores) == 0:
+        raise ValueError(f"No RAxML search of {prefix} finished.")
+    best = max(scores, key=scores.get)
+    os.makedirs(output_dir, exist_ok=True)
+    for name in sorted(os.listdir(best)):
+        if name.startswith("RAxML_") and os.path.isfile(os.path.join(best, name)):
+            shutil.copyfile(os.path.join(best, name), os.path.join(output_dir, name))
+    with open(os.path.join(output_dir, SEARCHES_FILE), 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(["search", "score", "best"])
+        for directory in searches:
+            writer.writerow([os.path.relpath(directory, output_dir), scores.get(directory, ""), int(directory == best)])
+    return best, scores[best]
+
+
+def best_command(searches, output_dir, prefix):
+    # Command of the bash app that chooses the best tree of the searches of a gene
+    cmd = f"{sys.executable} {os.path.abspath(__file__)} {shlex.quote(str(output_dir))} {shlex.quote(prefix)}"
+    return cmd + " " + " ".join(shlex.quote(str(d)) for d in searches)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chooses the RAxML search with the best likelihood.")
+    parser.add_argument("output_dir", help="Gene folder that receives the files of the best search.")
+    parser.add_argument("prefix", help="Prefix of the gene (RAxML_info.<prefix>_output.tree).")
+    parser.add_argument("searches", help="Folders of the seeded searches.", nargs="+")
+    args = parser.parse_args()
+    try:
+        best, score = publish_best(args.searches, args.output_dir, args.prefix)
+    except ValueError as e:
+        parser.exit(1, f"{e}\n")
+    print(f"Best tree of {args.prefix}: {best} ({score})")